@@ -7,21 +7,42 @@ from fastapi.staticfiles import StaticFiles
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
 from selenium.common.exceptions import WebDriverException, TimeoutException, NoSuchElementException
-import schedule
 import time
 import threading
+import asyncio
 import json
 import os
 import platform
-import random
-from datetime import datetime, timedelta
+import hashlib
+import base64
+import gzip
+import mimetypes
+import sqlite3
+import signal
+import re
+from datetime import datetime
 from threading import Lock
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 import logging
 from pathlib import Path
-from fastapi.responses import HTMLResponse, JSONResponse
-from functools import lru_cache
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import parse_qsl, urlsplit, urlunsplit
+import urllib3
+from starlette.datastructures import Headers
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import brotli
+except ImportError:  # brotli为可选依赖，未安装时只提供gzip压缩
+    brotli = None
+try:
+    import fcntl
+except ImportError:  # Windows没有文件锁，只按单进程运行
+    fcntl = None
 
 # 加载环境变量
 load_dotenv()
@@ -53,26 +74,279 @@ update_status = {
     "last_update_time": None,
     "last_error": None,
     "current_step": None,
-    "next_update_time": None
+    "next_update_time": None,
+    "step_timings": {},  # 最近一次刷新中各步骤的耗时（秒）
+    "last_duration": None  # 最近一次刷新的总耗时（秒）
 }
-update_lock = Lock()
 
-# 添加缓存装饰器
-@lru_cache(maxsize=1)
+class MetricsRegistry:
+    """进程内的Prometheus文本格式指标，计数器和直方图在事件发生时记录，仪表盘在采集时计算"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._meta = {}  # 指标名 -> (类型, 说明, 直方图分桶)
+        self._values = {}  # (指标名, 标签) -> 数值或直方图状态
+        self._collectors = []
+
+    def counter(self, name, help_text):
+        self._meta[name] = ("counter", help_text, None)
+
+    def gauge(self, name, help_text):
+        self._meta[name] = ("gauge", help_text, None)
+
+    def histogram(self, name, help_text, buckets):
+        self._meta[name] = ("histogram", help_text, tuple(buckets))
+
+    def add_collector(self, collect):
+        """collect() 返回 [(指标名, 标签, 数值)]，每次采集时调用"""
+        self._collectors.append(collect)
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        buckets = self._meta[name][2]
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    state["buckets"][i] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    def value(self, name, labels=None):
+        return self._values.get((name, tuple(sorted((labels or {}).items()))), 0)
+
+    def render(self):
+        samples = {}
+        with self._lock:
+            for (name, labels), value in self._values.items():
+                if isinstance(value, dict):
+                    # 复制直方图状态，在锁外格式化
+                    value = dict(value, buckets=list(value["buckets"]))
+                samples.setdefault(name, []).append((labels, value))
+        for collect in self._collectors:
+            try:
+                for name, labels, value in collect():
+                    samples.setdefault(name, []).append((tuple(sorted(labels.items())), value))
+            except Exception as e:
+                logger.warning(f"采集指标失败: {str(e)}")
+
+        lines = []
+        for name, (kind, help_text, buckets) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(samples.get(name, []), key=lambda sample: sample[0]):
+                if kind == "histogram":
+                    for bound, count in zip(buckets, value["buckets"]):
+                        lines.append(f"{name}_bucket{format_metric_labels(labels + (('le', format_metric_value(bound)),))} {count}")
+                    lines.append(f"{name}_bucket{format_metric_labels(labels + (('le', '+Inf'),))} {value['count']}")
+                    lines.append(f"{name}_sum{format_metric_labels(labels)} {format_metric_value(value['sum'])}")
+                    lines.append(f"{name}_count{format_metric_labels(labels)} {value['count']}")
+                else:
+                    lines.append(f"{name}{format_metric_labels(labels)} {format_metric_value(value)}")
+        return "\n".join(lines) + "\n"
+
+def format_metric_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+def format_metric_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+metrics = MetricsRegistry()
+metrics.histogram("coze_scrape_duration_seconds", "一次完整刷新的耗时", (1, 2, 5, 10, 30, 60, 120, 300, 600))
+metrics.histogram("coze_scrape_step_duration_seconds", "刷新中各步骤的耗时", (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+metrics.counter("coze_scrape_retries_total", "retry装饰器触发的重试次数")
+metrics.counter("coze_screenshots_total", "抓取出错时保存的截图数量")
+metrics.counter("coze_browser_launches_total", "启动的浏览器数量")
+metrics.gauge("coze_invite_codes_available", "各来源未激活的邀请码数量")
+metrics.counter("coze_dispense_total", "/api/get_invite_code 和 /api/get_invite_codes 请求数，按结果区分")
+metrics.histogram("coze_dispense_latency_seconds", "领取接口的响应耗时", (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30, 120))
+metrics.counter("coze_cache_requests_total", "预序列化响应缓存的访问次数，按是否命中区分")
+metrics.gauge("coze_cache_hit_ratio", "预序列化响应缓存的命中率")
+
+class ResponseCache:
+    """按数据版本缓存预先序列化好的接口响应，版本变化或超过有效期后重新生成"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = Lock()
+
+    def get(self, name, version, modified_at, build):
+        entry = self._entries.get(name)
+        if entry and entry["version"] == version and time.time() - entry["built_at"] < self.ttl:
+            metrics.inc("coze_cache_requests_total", {"cache": name, "result": "hit"})
+            return entry
+        metrics.inc("coze_cache_requests_total", {"cache": name, "result": "miss"})
+
+        # 在锁外生成响应，避免阻塞其他接口
+        data = build()
+        body = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        entry = {
+            "version": version,
+            "built_at": time.time(),
+            "data": data,
+            "body": body,
+            "etag": f'"{hashlib.sha1(body).hexdigest()[:20]}"',
+            "modified_at": int(modified_at),
+            "last_modified": formatdate(modified_at, usegmt=True)
+        }
+        with self._lock:
+            self._entries[name] = entry
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+response_cache = ResponseCache(CACHE_TTL)
+
+def collect_cache_hit_ratio():
+    ratios = []
+    for cache in ("codes", "invite_codes"):
+        hits = metrics.value("coze_cache_requests_total", {"cache": cache, "result": "hit"})
+        misses = metrics.value("coze_cache_requests_total", {"cache": cache, "result": "miss"})
+        if hits + misses:
+            ratios.append(("coze_cache_hit_ratio", {"cache": cache}, round(hits / (hits + misses), 4)))
+    return ratios
+
+metrics.add_collector(collect_cache_hit_ratio)
+
+# SSE推送配置
+SSE_KEEPALIVE = 15  # 没有事件时发送心跳的间隔（秒）
+SSE_COALESCE = 0.1  # 合并短时间内连续变化的时间窗口（秒）
+
+class EventBroadcaster:
+    """把状态变化和邀请码变化推送给所有SSE订阅者，可以在任意线程中调用publish"""
+
+    def __init__(self):
+        self._loop = None
+        self._subscribers = set()
+        self._pending = set()
+        self._scheduled = False
+
+    def bind_loop(self, loop):
+        self._loop = loop
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=100)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+    def publish(self, kind):
+        """kind为 "status" 或 "codes"，只记录变化类型，实际内容在事件循环中合并后生成"""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        loop.call_soon_threadsafe(self._mark, kind)
+
+    def _mark(self, kind):
+        self._pending.add(kind)
+        if not self._scheduled and self._subscribers:
+            self._scheduled = True
+            self._loop.call_later(SSE_COALESCE, self._flush)
+
+    def _flush(self):
+        kinds = self._pending
+        self._pending = set()
+        self._scheduled = False
+        if not self._subscribers:
+            return
+
+        # 邀请码变化时推送完整数据（复用预先序列化的响应），否则只推送状态
+        if "codes" in kinds:
+            message = format_sse("invite_codes", get_invite_codes_entry()["body"].decode('utf-8'))
+        else:
+            message = format_sse("status", json.dumps(build_status_payload(), ensure_ascii=False, separators=(',', ':')))
+
+        for queue in list(self._subscribers):
+            if queue.full():
+                # 客户端消费太慢时丢弃最旧的事件
+                queue.get_nowait()
+            queue.put_nowait(message)
+
+event_broadcaster = EventBroadcaster()
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {data}\n\n"
+
+def get_cached_entry():
+    version, modified_at = inventory.version_info()
+    return response_cache.get("codes", version, modified_at, inventory.snapshot)
+
 def get_cached_data():
     """获取缓存的数据"""
-    return load_data()
+    return get_cached_entry()["data"]
 
 def invalidate_cache():
     """使缓存失效"""
-    get_cached_data.cache_clear()
+    response_cache.clear()
+
+# 各线程当前正在计时的步骤
+step_context = threading.local()
+
+# 状态版本号，状态每次变化时递增，用于生成缓存的状态接口响应
+update_status_version = {"version": 0, "modified_at": time.time()}
+update_status_version_lock = Lock()
+
+def touch_update_status():
+    """状态发生变化后递增版本号，并通知SSE订阅者；负责刷新的进程同时把状态写入共享文件"""
+    with update_status_version_lock:
+        update_status_version["version"] += 1
+        update_status_version["modified_at"] = time.time()
+    event_broadcaster.publish("status")
+    if coordinator.is_leader:
+        coordinator.write_status()
+
+def set_update_status(**kwargs):
+    """更新状态字段"""
+    update_status.update(kwargs)
+    touch_update_status()
 
 def update_status_step(step: str):
-    """更新当前执行步骤"""
+    """更新当前执行步骤，同时结束上一步骤的计时"""
     global update_status
-    update_status["current_step"] = step
+    finish_status_step()
+    # 并发抓取多个账号时，在步骤名前加上账号来源
+    account = getattr(step_context, "account", None)
+    step_context.name = step
+    if account:
+        step = f"[{account}] {step}"
+    step_context.step = step
+    step_context.started = time.perf_counter()
+    set_update_status(current_step=step)
     logger.info(f"当前步骤: {step}")
 
+def finish_status_step():
+    """结束当前线程正在计时的步骤并记录耗时"""
+    step = getattr(step_context, "step", None)
+    if step is None:
+        return
+    elapsed = time.perf_counter() - step_context.started
+    step_context.step = None
+    update_status["step_timings"][step] = round(elapsed, 3)
+    metrics.observe("coze_scrape_step_duration_seconds", elapsed, {
+        "step": step_context.name,
+        "source": getattr(step_context, "account", None) or ""
+    })
+    touch_update_status()
+    logger.info(f"步骤 {step} 耗时 {elapsed:.2f} 秒")
+
 # 获取Chrome和ChromeDriver路径
 def get_chrome_paths():
     system = platform.system().lower()
@@ -108,6 +382,7 @@ def retry(max_tries=3, delay_seconds=5):
                         logger.error(f"重试{max_tries}次后仍然失败: {str(e)}")
                         raise
                     logger.warning(f"操作失败，{delay_seconds}秒后尝试第{tries+1}次重试: {str(e)}")
+                    metrics.inc("coze_scrape_retries_total", {"function": func.__name__})
                     time.sleep(delay_seconds)
             return None
         return wrapper
@@ -155,22 +430,223 @@ def parse_invite_code_text(text):
         # 返回默认值
         return text, "未知状态"
 
-# 获取邀请码
-@retry(max_tries=3, delay_seconds=5)
-def get_invite_codes(account_id, password):
-    chrome_path, chromedriver_path = get_chrome_paths()
-    
+# 浏览器池配置
+BROWSER_POOL_SIZE = int(os.getenv("BROWSER_POOL_SIZE", "2"))  # 常驻浏览器数量上限
+BROWSER_MAX_USES = int(os.getenv("BROWSER_MAX_USES", "20"))  # 单个浏览器最多复用次数
+BROWSER_MAX_RSS_MB = int(os.getenv("BROWSER_MAX_RSS_MB", "800"))  # 浏览器进程树内存上限(MB)
+
+# 精简的浏览器配置：屏蔽图片、字体、媒体和统计脚本（CDP Network.setBlockedURLs 通配符），使用较小的窗口
+RESOURCE_BLOCKING = os.getenv("RESOURCE_BLOCKING", "true").lower() == "true"
+DEFAULT_BLOCKED_URL_PATTERNS = (
+    "*.png*,*.jpg*,*.jpeg*,*.gif*,*.webp*,*.avif*,*.ico*,"
+    "*.woff*,*.ttf*,*.otf*,*.mp4*,*.webm*,*.mp3*,"
+    "*google-analytics.com*,*googletagmanager.com*,*hm.baidu.com*,*mcs.zijieapi.com*,*mon.zijieapi.com*"
+)
+BLOCKED_URL_PATTERNS = [p.strip() for p in os.getenv("BLOCKED_URL_PATTERNS", DEFAULT_BLOCKED_URL_PATTERNS).split(",") if p.strip()]
+BROWSER_WINDOW_SIZE = os.getenv("BROWSER_WINDOW_SIZE", "1280,800")
+
+CHROME_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+# 登录页和邀请码页地址，离线测试时可以指向本地模拟站点（fake_coze.py）
+COZE_LOGIN_URL = os.getenv("COZE_LOGIN_URL", "https://www.coze.cn/space-preview?")
+COZE_INVITE_URL = os.getenv("COZE_INVITE_URL", "https://space.coze.cn/?from=landingpage")
+
+# 页面就绪判定：静默窗口内既没有DOM变化也没有新的网络请求完成
+PAGE_SETTLE_QUIET_MS = int(os.getenv("PAGE_SETTLE_QUIET_MS", "500"))
+PAGE_SETTLE_TIMEOUT = float(os.getenv("PAGE_SETTLE_TIMEOUT", "10"))
+
+WAIT_FOR_SETTLE_JS = """
+    const quietMs = arguments[0], timeoutMs = arguments[1], done = arguments[arguments.length - 1];
+    performance.setResourceTimingBufferSize(10000);
+    const start = Date.now();
+    let last = start;
+    let resources = performance.getEntriesByType('resource').length;
+    const observer = new MutationObserver(() => { last = Date.now(); });
+    observer.observe(document.documentElement, {childList: true, subtree: true, attributes: true, characterData: true});
+    const timer = setInterval(() => {
+        const count = performance.getEntriesByType('resource').length;
+        if (count !== resources) {
+            resources = count;
+            last = Date.now();
+        }
+        const now = Date.now();
+        const settled = document.readyState === 'complete' && now - last >= quietMs;
+        if (settled || now - start >= timeoutMs) {
+            clearInterval(timer);
+            observer.disconnect();
+            done(settled);
+        }
+    }, 50);
+"""
+
+def wait_for_page_settled(driver, quiet_ms=PAGE_SETTLE_QUIET_MS, timeout=PAGE_SETTLE_TIMEOUT):
+    """等待页面DOM和网络请求都安静下来，超时后不报错直接继续"""
+    try:
+        settled = driver.execute_async_script(WAIT_FOR_SETTLE_JS, quiet_ms, int(timeout * 1000))
+        if not settled:
+            logger.info(f"页面在 {timeout} 秒内未完全静止，继续执行")
+    except TimeoutException:
+        logger.info("等待页面静止超时，继续执行")
+
+# 邀请码抓取方式：network 从浏览器网络响应中读取邀请码接口的JSON，dom 从页面元素中解析，
+# auto 优先使用网络响应，没有捕获到时退回页面解析
+SCRAPE_CAPTURE_MODE = os.getenv("SCRAPE_CAPTURE_MODE", "auto").lower()
+INVITE_API_PATTERN = re.compile(os.getenv("INVITE_API_PATTERN", "invit"), re.IGNORECASE)  # 邀请码接口地址匹配规则
+CAPTURE_WAIT_TIMEOUT = float(os.getenv("CAPTURE_WAIT_TIMEOUT", "10"))  # 点击立即邀请后等待接口响应的时间（秒）
+
+INVITE_CODE_KEYS = ("code", "invite_code", "inviteCode", "invitation_code", "invitationCode")
+INVITE_USED_KEYS = ("used", "is_used", "isUsed", "activated", "is_activated", "isActivated")
+
+# 最近一次捕获到的邀请码接口 {"url", "method", "body"}，按账号记录
+captured_invite_endpoints = {}
+
+def parse_invite_codes_json(payload):
+    """在接口返回的JSON中查找邀请码列表，返回 [{"code", "status"}]，找不到时返回None"""
+    if isinstance(payload, list):
+        items = [item for item in payload if isinstance(item, dict)]
+        if items and all(any(isinstance(item.get(key), str) for key in INVITE_CODE_KEYS) for item in items):
+            codes = []
+            for item in items:
+                code = next(item[key] for key in INVITE_CODE_KEYS if isinstance(item.get(key), str))
+                codes.append({"code": code.strip(), "status": parse_invite_code_status(item)})
+            return codes
+        children = payload
+    elif isinstance(payload, dict):
+        children = payload.values()
+    else:
+        return None
+
+    for child in children:
+        codes = parse_invite_codes_json(child)
+        if codes:
+            return codes
+    return None
+
+def parse_invite_code_status(item):
+    """把接口中的状态字段转换成页面上显示的状态文字"""
+    for key in ("status", "state", "status_text", "statusText"):
+        value = item.get(key)
+        if isinstance(value, str) and value.strip() and not value.strip().isdigit():
+            return value.strip()
+    for key in INVITE_USED_KEYS:
+        if key in item:
+            return "已激活" if item[key] else "未激活"
+    return "未知状态"
+
+class InviteCodeCapture:
+    """通过Chrome性能日志监听网络响应，捕获邀请码接口返回的JSON"""
+
+    def __init__(self, driver, account_id=None):
+        self.driver = driver
+        self.account_id = account_id
+        self.codes = None
+        self._requests = {}
+        self._pending = {}
+        # 丢弃浏览器复用前积累的旧日志
+        self._read_log()
+
+    def _read_log(self):
+        try:
+            return self.driver.get_log("performance")
+        except Exception as e:
+            logger.debug(f"读取性能日志失败: {str(e)}")
+            return []
+
+    def poll(self):
+        """处理新的网络事件，捕获到邀请码后返回邀请码列表，否则返回None"""
+        if self.codes is not None:
+            return self.codes
+
+        for entry in self._read_log():
+            try:
+                message = json.loads(entry["message"])["message"]
+            except (KeyError, ValueError):
+                continue
+            method = message.get("method")
+            params = message.get("params", {})
+
+            if method == "Network.requestWillBeSent":
+                request = params.get("request", {})
+                if INVITE_API_PATTERN.search(request.get("url", "")):
+                    self._requests[params["requestId"]] = {
+                        "url": request["url"],
+                        "method": request.get("method", "GET"),
+                        "body": request.get("postData")
+                    }
+            elif method == "Network.responseReceived":
+                response = params.get("response", {})
+                if "json" in response.get("mimeType", "") and INVITE_API_PATTERN.search(response.get("url", "")):
+                    self._pending[params["requestId"]] = response["url"]
+            elif method == "Network.loadingFinished" and params.get("requestId") in self._pending:
+                request_id = params["requestId"]
+                url = self._pending.pop(request_id)
+                codes = self._read_response(request_id, url)
+                if codes:
+                    logger.info(f"从接口响应中获取到 {len(codes)} 个邀请码: {url}")
+                    self.codes = codes
+                    if self.account_id:
+                        captured_invite_endpoints[self.account_id] = self._requests.get(
+                            request_id, {"url": url, "method": "GET", "body": None}
+                        )
+                    return codes
+        return None
+
+    def _read_response(self, request_id, url):
+        try:
+            result = self.driver.execute_cdp_cmd("Network.getResponseBody", {"requestId": request_id})
+            body = result.get("body", "")
+            if result.get("base64Encoded"):
+                body = base64.b64decode(body).decode("utf-8")
+            codes = parse_invite_codes_json(json.loads(body))
+        except Exception as e:
+            logger.debug(f"解析接口响应失败 {url}: {str(e)}")
+            return None
+        # 状态全部无法识别时认为不是邀请码接口，留给页面解析
+        if codes and all(item["status"] == "未知状态" for item in codes):
+            logger.info(f"接口响应中的邀请码状态无法识别，忽略: {url}")
+            return None
+        return codes
+
+    def wait(self, timeout=CAPTURE_WAIT_TIMEOUT):
+        """等待邀请码接口响应，超时返回None"""
+        deadline = time.time() + timeout
+        while True:
+            codes = self.poll()
+            if codes is not None or time.time() >= deadline:
+                return codes
+            time.sleep(0.1)
+
+def wait_for_ready_state(driver, wait):
+    wait.until(lambda d: d.execute_script('return document.readyState') == 'complete')
+
+def has_login_button(driver):
+    return driver.execute_script(
+        "return Array.from(document.querySelectorAll('button')).some(btn => btn.textContent.includes('登录'))"
+    )
+
+def build_chrome_options(blocking=RESOURCE_BLOCKING):
+    """构建无头Chrome启动参数，使用较小的窗口并关闭抓取用不到的后台功能"""
+    chrome_path, _ = get_chrome_paths()
+
     chrome_options = Options()
     chrome_options.add_argument('--headless')
     chrome_options.add_argument('--no-sandbox')
     chrome_options.add_argument('--disable-dev-shm-usage')
-    chrome_options.add_argument('--window-size=1920,1080')
+    chrome_options.add_argument(f'--window-size={BROWSER_WINDOW_SIZE}')
     chrome_options.add_argument('--disable-blink-features=AutomationControlled')
     chrome_options.add_argument('--disable-extensions')
     chrome_options.add_argument('--disable-infobars')
     chrome_options.add_argument('--disable-popup-blocking')
-    chrome_options.add_argument('--start-maximized')
     chrome_options.add_argument('--disable-gpu')
+    chrome_options.add_argument('--mute-audio')
+    chrome_options.add_argument('--no-first-run')
+    chrome_options.add_argument('--disable-background-networking')
+    chrome_options.add_argument('--disable-default-apps')
+    chrome_options.add_argument('--disable-sync')
+    chrome_options.add_argument('--disable-features=Translate,MediaRouter,OptimizationHints')
+    if blocking:
+        # 不解码图片，配合Network.setBlockedURLs减少下载和渲染
+        chrome_options.add_argument('--blink-settings=imagesEnabled=false')
     # 移除可能导致稳定性问题的选项
     # chrome_options.add_argument('--memory-pressure-off')
     # chrome_options.add_argument('--single-process')
@@ -179,503 +655,2727 @@ def get_invite_codes(account_id, password):
     chrome_options.add_argument('--disable-dev-tools')
     # 使用normal替代eager，提高页面加载稳定性
     chrome_options.page_load_strategy = 'normal'
-    chrome_options.add_argument('--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36')
-    
+    if SCRAPE_CAPTURE_MODE != "dom":
+        # 开启性能日志以便读取网络响应
+        chrome_options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    chrome_options.add_argument(f'--user-agent={CHROME_USER_AGENT}')
+
     if chrome_path:
         chrome_options.binary_location = chrome_path
-    
-    driver = None
+
+    return chrome_options
+
+def apply_resource_blocking(driver, patterns=None):
+    """通过CDP屏蔽登录和读取邀请码用不到的资源请求"""
+    patterns = BLOCKED_URL_PATTERNS if patterns is None else patterns
+    if not patterns:
+        return
     try:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": patterns})
+    except Exception as e:
+        logger.warning(f"设置资源屏蔽失败: {str(e)}")
+
+def create_chrome_driver(blocking=RESOURCE_BLOCKING):
+    """启动一个新的Chrome实例，ChromeDriver及其启动的Chrome放在独立的进程组中"""
+    _, chromedriver_path = get_chrome_paths()
+    if platform.system().lower() == "windows":
         service = Service(executable_path=chromedriver_path)
-        driver = webdriver.Chrome(service=service, options=chrome_options)
-        
-        # 设置页面加载超时
-        driver.set_page_load_timeout(60)
-        # 设置脚本执行超时
-        driver.set_script_timeout(30)
-        
-        update_status_step("打开登录页面")
-        driver.get("https://www.coze.cn/space-preview?")
-        
-        wait = WebDriverWait(driver, 30)
-        
-        update_status_step("等待页面加载")
-        wait.until(lambda d: d.execute_script('return document.readyState') == 'complete')
-        # 添加额外等待，确保页面所有元素都加载完毕
-        time.sleep(3)
+    else:
+        service = Service(executable_path=chromedriver_path, popen_kw={"start_new_session": True})
+    driver = webdriver.Chrome(service=service, options=build_chrome_options(blocking))
+    process_reaper.register(driver)
+    metrics.inc("coze_browser_launches_total")
+    if blocking:
+        apply_resource_blocking(driver)
 
-        update_status_step("点击登录按钮")
-        # 使用JavaScript方法点击登录按钮（已验证有效）
-        try:
-            driver.execute_script("Array.from(document.querySelectorAll('button')).find(btn => btn.textContent.includes('登录')).click()")
-            logger.info("使用JavaScript查找并点击登录按钮")
-        except Exception as e:
-            logger.error(f"JavaScript点击失败: {str(e)}")
-            # 尝试备用方法
-            try:
-                buttons = driver.find_elements(By.TAG_NAME, 'button')
-                found = False
-                for button in buttons:
-                    if '登录' in button.text:
-                        button.click()
-                        logger.info(f"通过遍历找到并点击: {button.text}")
-                        found = True
-                        break
-                
-                if not found:
-                    logger.error("无法找到登录按钮")
-                    # 添加截图记录页面状态
-                    screenshot_path = f"error_screenshot_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-                    driver.save_screenshot(screenshot_path)
-                    logger.info(f"已保存错误截图到 {screenshot_path}")
-                    raise Exception("无法找到登录按钮")
-            except Exception as e:
-                logger.error(f"遍历按钮失败: {str(e)}")
-                raise
+    # 设置页面加载超时
+    driver.set_page_load_timeout(60)
+    # 设置脚本执行超时
+    driver.set_script_timeout(30)
+    return driver
 
-        update_status_step("等待登录对话框出现")
-        wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, 'div[role="dialog"]')))
+def quit_driver(driver):
+    """关闭浏览器，并清理该浏览器进程组中残留的进程"""
+    try:
+        logger.info("正在关闭浏览器...")
+        driver.quit()
+        logger.info("浏览器已关闭")
+    except Exception as e:
+        logger.error(f"关闭浏览器时出错: {str(e)}")
+    finally:
+        process_reaper.reap(driver)
 
-        update_status_step("切换到账号登录")
-        account_login_tab = wait.until(
-            EC.element_to_be_clickable((By.CSS_SELECTOR, '#arco-tabs-0-tab-1'))
-        )
-        account_login_tab.click()
+def scan_processes():
+    """读取/proc中所有进程的父进程和进程组，返回 {pid: (ppid, pgid)}，非Linux平台返回None"""
+    if not os.path.isdir("/proc"):
+        return None
 
-        update_status_step("输入账号信息")
-        account_input = wait.until(
-            EC.element_to_be_clickable((By.CSS_SELECTOR, '#Identity_input'))
-        )
-        account_input.send_keys(account_id)
+    processes = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", 'r') as f:
+                # 进程名可能包含空格，从最后一个右括号之后解析
+                fields = f.read().rsplit(')', 1)[1].split()
+            processes[int(entry)] = (int(fields[1]), int(fields[2]))
+        except (OSError, IndexError, ValueError):
+            continue
+    return processes
 
-        password_input = wait.until(
-            EC.element_to_be_clickable((By.CSS_SELECTOR, '#Password_input'))
-        )
-        password_input.send_keys(password)
+def get_process_tree_pids(pid, processes=None):
+    """返回进程及其所有子孙进程的PID"""
+    processes = processes if processes is not None else scan_processes()
+    if not pid or processes is None:
+        return []
 
-        update_status_step("提交登录")
-        submit_button = wait.until(
-            EC.element_to_be_clickable((By.CSS_SELECTOR, '#arco-tabs-0-panel-1 > div > div > form > div:nth-child(6) > button'))
-        )
-        submit_button.click()
+    children = {}
+    for child, (ppid, _) in processes.items():
+        children.setdefault(ppid, []).append(child)
 
-        update_status_step("等待登录完成")
-        wait.until(EC.url_contains('space'))
-        wait.until(lambda d: d.execute_script('return document.readyState') == 'complete')
+    pids = []
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        pids.append(current)
+        stack.extend(children.get(current, []))
+    return pids
 
-        # 添加短暂延迟确保页面完全加载
-        time.sleep(5)  # 增加延迟时间，确保登录完全完成
+def get_process_tree_rss(pid):
+    """统计进程及其所有子进程的常驻内存(字节)，仅支持Linux，其他平台返回None"""
+    if not pid or not os.path.isdir("/proc"):
+        return None
 
-        update_status_step("点击快速开始")
+    total = 0
+    for current in get_process_tree_pids(pid):
         try:
-            quick_start_button = wait.until(
-                EC.element_to_be_clickable((By.XPATH, "//div[contains(text(), '快速开始')]"))
-            )
-            quick_start_button.click()
-            # 添加点击后的短暂等待
-            time.sleep(2)
-        except TimeoutException:
-            logger.warning("点击快速开始按钮超时，直接访问邀请码页面")
-            driver.get("https://space.coze.cn/?from=landingpage")
-            time.sleep(3)  # 给页面加载一些时间
-        except Exception as e:
-            logger.warning(f"点击快速开始按钮失败: {str(e)}，尝试直接访问邀请码页面")
-            driver.get("https://space.coze.cn/?from=landingpage")
-            time.sleep(3)  # 给页面加载一些时间
+            with open(f"/proc/{current}/status", 'r') as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except (OSError, ValueError):
+            continue
+    return total
 
-        update_status_step("点击立即邀请")
-        try:
-            invite_now_button = wait.until(
-                EC.element_to_be_clickable((By.XPATH, "//button[contains(text(), '立即邀请')]"))
-            )
-            invite_now_button.click()
-            # 添加点击后的短暂等待
-            time.sleep(2)
-        except Exception as e:
-            logger.warning(f"点击立即邀请按钮失败: {str(e)}")
-            # 可能已经在邀请码页面
-            pass
+# 残留进程巡检间隔（秒）
+REAPER_INTERVAL = int(os.getenv("REAPER_INTERVAL", "60"))
 
-        update_status_step("获取邀请码信息")
-        # 等待页面完全加载
-        time.sleep(5)  # 增加等待时间
+class ProcessReaper:
+    """只清理本应用启动的浏览器进程，避免误杀同一主机上的其他Chrome"""
 
-        # 首先尝试使用 JavaScript 方法获取
-        codes = []
+    def __init__(self, interval):
+        self.interval = interval
+        self._groups = {}  # 进程组ID -> ChromeDriver进程PID
+        self._retired = set()  # 浏览器已关闭但可能还有残留进程的进程组
+        self._lock = Lock()
+        self._thread = None
+
+    def _get_pgid(self, pid):
+        if not hasattr(os, "getpgid"):
+            return None
         try:
-            elements = driver.execute_script("""
-                return Array.from(document.querySelectorAll(".invite-code-item")).map(el => el.innerText);
-            """)
-            
-            if elements:
-                logger.info("使用 JavaScript 方法获取邀请码")
-                for element_text in elements:
-                    try:
-                        # 使用安全解析函数
-                        code, status = parse_invite_code_text(element_text)
-                        if code:
-                            logger.info(f'邀请码: {code}, 状态: {status}')
-                            codes.append({
-                                'code': code.strip(),
-                                'status': status.strip()
-                            })
-                    except Exception as e:
-                        logger.error(f'处理邀请码文本时出错: {str(e)}')
-        except Exception as e:
-            logger.warning(f'JavaScript 方法获取失败，尝试备用方法: {str(e)}')
+            pgid = os.getpgid(pid)
+        except OSError:
+            return None
+        # 绝不向应用自身所在的进程组发送信号
+        return None if pgid == os.getpgrp() else pgid
 
-        # 如果 JavaScript 方法没有获取到数据，使用 Selenium 方法
-        if not codes:
-            logger.info("使用 Selenium 方法获取邀请码")
-            # 等待邀请码容器出现
-            try:
-                wait.until(
-                    EC.presence_of_element_located((By.CSS_SELECTOR, 'div[class*="invite-code"]'))
-                )
-                
-                # 获取所有邀请码容器
-                invite_containers = driver.find_elements(By.CSS_SELECTOR, 'div[class*="invite-code"]')
-                logger.info(f'找到 {len(invite_containers)} 个邀请码容器')
+    def register(self, driver):
+        """记录新启动的ChromeDriver进程组，并确保巡检线程在运行"""
+        process = getattr(driver.service, "process", None)
+        if process is None:
+            return
+        driver.reaper_pid = process.pid
+        driver.reaper_pgid = self._get_pgid(process.pid)
+        with self._lock:
+            if driver.reaper_pgid is not None:
+                self._groups[driver.reaper_pgid] = process.pid
+            if self._thread is None and self.interval > 0:
+                self._thread = threading.Thread(target=self._watchdog, daemon=True, name="process-reaper")
+                self._thread.start()
 
-                for container in invite_containers:
-                    try:
-                        # 使用 JavaScript 滚动到元素位置
-                        driver.execute_script("arguments[0].scrollIntoView(true);", container)
-                        time.sleep(0.5)
-
-                        # 尝试不同的选择器组合
-                        selectors = [
-                            ('.items-center.coz-fg-plus', 'div > div > div > div:nth-child(2) > div > span'),
-                            ('div[class*="invite-code"] > div.coz-fg-plus', 'div[class*="invite-code"] > div > button > div > span')
-                        ]
-
-                        for code_selector, status_selector in selectors:
-                            try:
-                                code_element = container.find_element(By.CSS_SELECTOR, code_selector)
-                                status_element = container.find_element(By.CSS_SELECTOR, status_selector)
-                                code = code_element.text.strip()
-                                status = status_element.text.strip()
-                                if code:  # 只要有code就添加，不强制要求status
-                                    codes.append({
-                                        'code': code,
-                                        'status': status if status else "未知状态"
-                                    })
-                                    break
-                            except:
-                                continue
-
-                    except Exception as e:
-                        logger.error(f'处理邀请码元素时出错: {str(e)}')
-                        continue
-            except Exception as e:
-                logger.error(f'定位邀请码容器时出错: {str(e)}')
-                # 保存截图记录页面状态
-                screenshot_path = f"error_invite_codes_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-                driver.save_screenshot(screenshot_path)
-                logger.info(f"已保存邀请码页面错误截图到 {screenshot_path}")
+    def reap(self, driver):
+        """终止某个浏览器的整个进程组或进程树"""
+        pid = getattr(driver, "reaper_pid", None)
+        if pid is None:
+            return
+        pgid = getattr(driver, "reaper_pgid", None)
 
-        if not codes:
-            logger.warning("未找到任何邀请码")
-            
-        return codes
-            
-    except Exception as e:
-        error_msg = f"获取邀请码过程中出错: {str(e)}"
-        logger.error(error_msg)
-        # 捕获异常后尝试保存截图
+        if pgid is not None:
+            with self._lock:
+                self._groups.pop(pgid, None)
+                self._retired.add(pgid)
+            self._kill_group(pgid)
+        elif platform.system().lower() == "windows":
+            os.system(f"taskkill /f /t /pid {pid} >NUL 2>&1")
+        else:
+            self._kill_pids(get_process_tree_pids(pid))
+
+    def _kill_group(self, pgid):
         try:
-            if driver:
-                screenshot_path = f"error_exception_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-                driver.save_screenshot(screenshot_path)
-                logger.info(f"已保存异常时截图到 {screenshot_path}")
-        except:
+            os.killpg(pgid, signal.SIGTERM)
+        except ProcessLookupError:
+            return True
+        except OSError as e:
+            logger.error(f"终止浏览器进程组 {pgid} 失败: {str(e)}")
+            return False
+
+        deadline = time.time() + 3
+        while time.time() < deadline:
+            try:
+                os.killpg(pgid, 0)
+            except ProcessLookupError:
+                return True
+            time.sleep(0.1)
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+            logger.info(f"已强制终止浏览器进程组 {pgid}")
+        except ProcessLookupError:
             pass
-        raise HTTPException(status_code=500, detail=error_msg)
-        
-    finally:
-        if driver:
+        return True
+
+    def _kill_pids(self, pids):
+        if not hasattr(signal, "SIGKILL"):
+            return
+        for pid in pids:
             try:
-                logger.info("正在关闭浏览器...")
-                driver.quit()
-                logger.info("浏览器已关闭")
-                
-                # 强制检查潜在的残留进程 (针对ChromeDriver)
-                if platform.system().lower() == "linux":
-                    try:
-                        os.system("pkill -f chromedriver")
-                        os.system("pkill -f chrome")
-                        logger.info("已清理可能残留的Chrome进程")
-                    except Exception as e:
-                        logger.error(f"清理Chrome进程时出错: {str(e)}")
-                elif platform.system().lower() == "darwin":  # macOS
-                    try:
-                        os.system("pkill -f 'Google Chrome'")
-                        os.system("pkill -f chromedriver")
-                        logger.info("已清理可能残留的Chrome进程")
-                    except Exception as e:
-                        logger.error(f"清理Chrome进程时出错: {str(e)}")
-                elif platform.system().lower() == "windows":
-                    try:
-                        os.system("taskkill /f /im chromedriver.exe")
-                        os.system("taskkill /f /im chrome.exe")
-                        logger.info("已清理可能残留的Chrome进程")
-                    except Exception as e:
-                        logger.error(f"清理Chrome进程时出错: {str(e)}")
-                
-            except Exception as e:
-                logger.error(f"关闭浏览器时出错: {str(e)}")
-                # 如果常规关闭失败，尝试更激进的方法
-                try:
-                    if hasattr(driver, 'service') and driver.service.process:
-                        driver.service.process.kill()
-                        logger.info("已强制终止ChromeDriver进程")
-                except Exception as e:
-                    logger.error(f"强制终止浏览器进程时出错: {str(e)}")
+                os.kill(pid, signal.SIGKILL)
+                logger.info(f"已清理残留的浏览器进程 {pid}")
+            except (ProcessLookupError, PermissionError):
+                continue
 
-# 修改 load_data 函数
-def load_data():
-    try:
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            return data
-    except FileNotFoundError:
-        return {"codes": [], "last_update": None, "next_update": None}
+    def sweep(self):
+        """清理已关闭浏览器的残留进程，以及脱离ChromeDriver进程树的孤儿进程"""
+        with self._lock:
+            retired = set(self._retired)
+            groups = dict(self._groups)
 
-# 修改 save_data 函数
-def save_data(data):
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    invalidate_cache()  # 保存数据时使缓存失效
+        for pgid in retired:
+            if self._kill_group(pgid):
+                with self._lock:
+                    self._retired.discard(pgid)
 
-# 获取一个未激活的邀请码并将其状态修改为已激活
-def get_and_activate_invite_code():
-    data = load_data()
-    codes = data.get("codes", [])
-    
-    # 查找未激活的邀请码
-    for i, code_item in enumerate(codes):
-        # 检查状态是否包含"未激活"字样
-        if "未激活" in code_item.get("status", ""):
-            # 获取邀请码数据
-            code_data = {
-                "code": code_item["code"],
-                "status": code_item["status"],
-                "source": code_item.get("source", "未知")
-            }
-            
-            # 更新状态为已激活
-            codes[i]["status"] = "已激活"
-            data["codes"] = codes
-            save_data(data)
-            
-            logger.info(f"邀请码 {code_data['code']} 已被激活")
-            return code_data
-    
-    # 没有找到未激活的邀请码
-    return None
+        processes = scan_processes()
+        if processes is None or not groups:
+            return
+        for pgid, root_pid in groups.items():
+            tree = set(get_process_tree_pids(root_pid, processes)) if root_pid in processes else set()
+            orphans = [pid for pid, (_, group) in processes.items() if group == pgid and pid not in tree]
+            if orphans:
+                logger.info(f"进程组 {pgid} 中发现 {len(orphans)} 个孤儿进程，正在清理")
+                self._kill_pids(orphans)
 
-# 更新邀请码
-def update_invite_codes():
-    global update_status
-    
-    if not update_lock.acquire(blocking=False):
-        logger.info("已有更新任务在运行中")
-        return
-    
-    try:
-        # 获取当前数据作为备份
-        current_data = load_data()
-        
-        update_status["is_updating"] = True
-        update_status["last_error"] = None
-        all_codes = []
-        current_time = datetime.now()
-        update_time = current_time.isoformat()
-        
-        # 获取账号1的邀请码
-        if os.getenv("ACCOUNT1_ID") and os.getenv("ACCOUNT1_PASSWORD"):
+    def reap_all(self):
+        """应用关闭时清理所有登记过的进程组"""
+        with self._lock:
+            pgids = set(self._groups) | self._retired
+            self._groups.clear()
+            self._retired.clear()
+        for pgid in pgids:
+            self._kill_group(pgid)
+
+    def _watchdog(self):
+        while True:
+            time.sleep(self.interval)
             try:
-                codes1 = get_invite_codes(os.getenv("ACCOUNT1_ID"), os.getenv("ACCOUNT1_PASSWORD"))
-                if codes1:
-                    all_codes.extend([{"code": code["code"], "status": code["status"], "source": "账号1"} for code in codes1])
+                self.sweep()
             except Exception as e:
-                error_msg = f"账号1获取邀请码失败: {str(e)}"
-                logger.error(error_msg)
-                update_status["last_error"] = error_msg
-        
-        # 获取账号2的邀请码
-        if os.getenv("ACCOUNT2_ID") and os.getenv("ACCOUNT2_PASSWORD"):
+                logger.error(f"巡检残留浏览器进程时出错: {str(e)}")
+
+process_reaper = ProcessReaper(REAPER_INTERVAL)
+
+class BrowserPool:
+    """按账号保留常驻的无头浏览器，刷新时复用已登录的浏览器而不是每次冷启动"""
+
+    def __init__(self, max_size, max_uses, max_rss_mb):
+        self.max_size = max(1, max_size)
+        self.max_uses = max_uses
+        self.max_rss_bytes = max_rss_mb * 1024 * 1024
+        self._entries = {}
+        self._cond = threading.Condition()
+        self._closed = False
+
+    @contextmanager
+    def borrow(self, key):
+        """借出指定账号的浏览器，出错时销毁该浏览器，正常归还时保留复用"""
+        entry = self._acquire(key)
+        healthy = False
+        try:
+            yield entry
+            healthy = True
+        finally:
+            self._release(key, entry, discard=not healthy)
+
+    def _acquire(self, key):
+        evicted = None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("浏览器池已关闭")
+                entry = self._entries.get(key)
+                if entry is not None:
+                    if not entry["in_use"]:
+                        entry["in_use"] = True
+                        break
+                elif len(self._entries) < self.max_size or self._has_idle_locked():
+                    if len(self._entries) >= self.max_size:
+                        evicted = self._evict_idle_locked()
+                    entry = {"driver": None, "uses": 0, "created": None,
+                             "last_used": None, "in_use": True, "logged_in": False}
+                    self._entries[key] = entry
+                    break
+                self._cond.wait()
+
+        if evicted is not None:
+            quit_driver(evicted)
+
+        if entry["driver"] is not None and not self._is_reusable(entry):
+            quit_driver(entry["driver"])
+            entry["driver"] = None
+
+        if entry["driver"] is None:
             try:
-                codes2 = get_invite_codes(os.getenv("ACCOUNT2_ID"), os.getenv("ACCOUNT2_PASSWORD"))
-                if codes2:
-                    all_codes.extend([{"code": code["code"], "status": code["status"], "source": "账号2"} for code in codes2])
-            except Exception as e:
-                error_msg = f"账号2获取邀请码失败: {str(e)}"
-                logger.error(error_msg)
-                if not update_status["last_error"]:  # 如果之前没有错误
-                    update_status["last_error"] = error_msg
-        
-        # 生成下次更新时间（10-20分钟之间随机）
-        minutes = random.randint(30, 40)
-        next_update = current_time + timedelta(minutes=minutes)
-        next_update_timestamp = int(next_update.timestamp() * 1000)  # 转换为毫秒时间戳
-        
-        logger.info(f"下次更新时间设置为 {minutes} 分钟后")
-        
-        # 只有在成功获取到新数据时才更新
-        if all_codes:
-            data = {
-                "codes": all_codes,
-                "last_update": update_time,
-                "next_update": next_update_timestamp
-            }
-            save_data(data)
-            update_status["last_update_time"] = update_time
-            update_status["next_update_time"] = next_update_timestamp
-            return data
+                logger.info(f"启动新的浏览器实例，当前池大小: {len(self._entries)}/{self.max_size}")
+                entry["driver"] = create_chrome_driver()
+            except Exception:
+                with self._cond:
+                    self._entries.pop(key, None)
+                    self._cond.notify_all()
+                raise
+            entry["uses"] = 0
+            entry["created"] = time.time()
+            entry["logged_in"] = False
         else:
-            # 如果没有获取到新数据，保持使用原有数据
-            logger.warning("未获取到新数据，保持使用原有数据")
-            current_data["next_update"] = next_update_timestamp
-            save_data(current_data)
-            update_status["next_update_time"] = next_update_timestamp
-            return current_data
-        
-    except Exception as e:
-        error_msg = f"更新邀请码失败: {str(e)}"
-        logger.error(error_msg)
-        update_status["last_error"] = error_msg
-        raise
-    
-    finally:
-        update_status["is_updating"] = False
-        update_status["current_step"] = None
-        update_lock.release()
+            logger.info(f"复用常驻浏览器，已使用 {entry['uses']} 次")
 
-# 修改 API 端点
-@app.get("/api/codes")
-def get_codes():
-    return get_cached_data()
+        entry["uses"] += 1
+        return entry
 
-@app.get('/api/invite_codes')
-async def get_invite_codes_api():
-    """获取邀请码数据"""
-    data = get_cached_data()
-    return {
-        "is_updating": update_status["is_updating"],
-        "current_step": update_status["current_step"],
-        "last_update_time": update_status["last_update_time"],
-        "next_update_time": update_status["next_update_time"],
-        "last_error": update_status["last_error"],
-        "codes": data.get("codes", [])
-    }
+    def _release(self, key, entry, discard=False):
+        driver = None
+        with self._cond:
+            entry["in_use"] = False
+            entry["last_used"] = time.time()
+            if discard or self._closed or entry["driver"] is None:
+                driver = entry["driver"]
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+            self._cond.notify_all()
 
-@app.get('/api/get_invite_code')
-async def get_unused_invite_code():
-    """获取一个未激活的邀请码并将其状态改为已激活"""
-    # 先从现有数据中尝试获取未激活邀请码
-    invite_code = get_and_activate_invite_code()
-    
-    # 如果找到了未激活的邀请码，直接返回
-    if invite_code:
-        return JSONResponse(content={
-            "success": True,
-            "code": invite_code["code"],
-            "status": "未激活",  # 新状态
-            "source": invite_code["source"],
-            "message": "获取邀请码成功"
-        })
-    
-    # 如果没有找到未激活的邀请码，触发更新
-    if update_status["is_updating"]:
-        return JSONResponse(
-            status_code=423,
-            content={
-                "success": False,
-                "message": "正在更新邀请码数据，请稍后再试",
-                "current_step": update_status["current_step"]
-            }
-        )
-    
-    try:
-        # 启动一个新线程进行更新，不阻塞当前请求
-        def update_thread():
-            try:
-                update_invite_codes()
-            except Exception as e:
-                logger.error(f"更新线程中出错: {str(e)}")
-        
-        threading.Thread(target=update_thread, daemon=True).start()
-        
-        return JSONResponse(
-            status_code=202,
-            content={
-                "success": False,
-                "message": "没有可用的邀请码，已触发更新，请稍后再试"
-            }
-        )
-    except Exception as e:
-        return JSONResponse(
-            status_code=500,
-            content={
-                "success": False,
-                "message": f"获取邀请码失败: {str(e)}"
-            }
-        )
+        if driver is not None:
+            quit_driver(driver)
+
+    def _has_idle_locked(self):
+        return any(not e["in_use"] for e in self._entries.values())
+
+    def _evict_idle_locked(self):
+        """淘汰最久未使用的空闲浏览器，返回需要关闭的driver"""
+        idle = [(e["last_used"] or 0, k) for k, e in self._entries.items() if not e["in_use"]]
+        if not idle:
+            return None
+        _, key = min(idle)
+        logger.info("浏览器池已满，淘汰最久未使用的浏览器")
+        return self._entries.pop(key)["driver"]
+
+    def _is_reusable(self, entry):
+        """检查浏览器是否健康且未超过复用次数和内存上限"""
+        driver = entry["driver"]
+        if self.max_uses and entry["uses"] >= self.max_uses:
+            logger.info(f"浏览器已复用 {entry['uses']} 次，达到上限，重新启动")
+            return False
 
-def schedule_jobs():
-    """定时任务"""
-    logger.info("启动定时任务")
-    
-    def random_update():
         try:
-            data = update_invite_codes()
-            if data and data.get("next_update"):
-                next_delay = (data["next_update"] - int(datetime.now().timestamp() * 1000)) / 60000
-                schedule.clear()
-                schedule.every(next_delay).minutes.do(random_update)
+            driver.execute_script("return 1")
+            driver.window_handles
         except Exception as e:
-            logger.error(f"更新任务出错: {str(e)}")
-            # 添加安全兜底，确保即使出错也会在一段时间后重试
-            schedule.clear()
-            schedule.every(15).minutes.do(random_update)  # 出错后15分钟再尝试
+            logger.warning(f"浏览器健康检查失败，重新启动: {str(e)}")
+            return False
 
-    random_update()
-    
+        pid = driver.service.process.pid if getattr(driver.service, "process", None) else None
+        rss = get_process_tree_rss(pid)
+        if rss is not None and self.max_rss_bytes and rss > self.max_rss_bytes:
+            logger.info(f"浏览器内存占用 {rss // (1024 * 1024)}MB 超过上限，重新启动")
+            return False
+
+        return True
+
+    def close_all(self):
+        """关闭池中所有浏览器"""
+        with self._cond:
+            self._closed = True
+            drivers = [e["driver"] for e in self._entries.values() if not e["in_use"] and e["driver"]]
+            self._entries = {k: e for k, e in self._entries.items() if e["in_use"]}
+            self._cond.notify_all()
+
+        for driver in drivers:
+            quit_driver(driver)
+
+browser_pool = BrowserPool(BROWSER_POOL_SIZE, BROWSER_MAX_USES, BROWSER_MAX_RSS_MB)
+
+def check_logged_in(driver):
+    """判断当前页面是否处于已登录状态"""
+    if urlsplit(COZE_INVITE_URL).netloc not in driver.current_url:
+        return False
+    try:
+        return not driver.execute_script(
+            "return Array.from(document.querySelectorAll('button')).some(btn => btn.textContent.trim() === '登录')"
+        )
+    except Exception:
+        return False
+
+def login_account(driver, wait, account_id, password, capture=None):
+    """执行完整的账号密码登录流程，登录后已经捕获到邀请码接口时跳过后续点击"""
+    update_status_step("打开登录页面")
+    driver.get(COZE_LOGIN_URL)
+
+    update_status_step("等待页面加载")
+    wait_for_ready_state(driver, wait)
+    # 等待登录按钮渲染出来，而不是固定等待
+    try:
+        wait.until(has_login_button)
+    except TimeoutException:
+        logger.warning("等待登录按钮出现超时")
+
+    update_status_step("点击登录按钮")
+    # 使用JavaScript方法点击登录按钮（已验证有效）
+    try:
+        driver.execute_script("Array.from(document.querySelectorAll('button')).find(btn => btn.textContent.includes('登录')).click()")
+        logger.info("使用JavaScript查找并点击登录按钮")
+    except Exception as e:
+        logger.error(f"JavaScript点击失败: {str(e)}")
+        # 尝试备用方法
+        try:
+            buttons = driver.find_elements(By.TAG_NAME, 'button')
+            found = False
+            for button in buttons:
+                if '登录' in button.text:
+                    button.click()
+                    logger.info(f"通过遍历找到并点击: {button.text}")
+                    found = True
+                    break
+
+            if not found:
+                logger.error("无法找到登录按钮")
+                # 添加截图记录页面状态
+                screenshot_path = f"error_screenshot_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
+                driver.save_screenshot(screenshot_path)
+                metrics.inc("coze_screenshots_total", {"kind": "login"})
+                logger.info(f"已保存错误截图到 {screenshot_path}")
+                raise Exception("无法找到登录按钮")
+        except Exception as e:
+            logger.error(f"遍历按钮失败: {str(e)}")
+            raise
+
+    update_status_step("等待登录对话框出现")
+    wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, 'div[role="dialog"]')))
+
+    update_status_step("切换到账号登录")
+    account_login_tab = wait.until(
+        EC.element_to_be_clickable((By.CSS_SELECTOR, '#arco-tabs-0-tab-1'))
+    )
+    account_login_tab.click()
+
+    update_status_step("输入账号信息")
+    account_input = wait.until(
+        EC.element_to_be_clickable((By.CSS_SELECTOR, '#Identity_input'))
+    )
+    account_input.send_keys(account_id)
+
+    password_input = wait.until(
+        EC.element_to_be_clickable((By.CSS_SELECTOR, '#Password_input'))
+    )
+    password_input.send_keys(password)
+
+    update_status_step("提交登录")
+    submit_button = wait.until(
+        EC.element_to_be_clickable((By.CSS_SELECTOR, '#arco-tabs-0-panel-1 > div > div > form > div:nth-child(6) > button'))
+    )
+    submit_button.click()
+
+    update_status_step("等待登录完成")
+    # 登录前的预览页地址也包含space，需要同时等待登录表单消失
+    wait.until(EC.url_contains('space'))
+    wait.until(EC.invisibility_of_element_located((By.CSS_SELECTOR, '#Identity_input')))
+    wait_for_ready_state(driver, wait)
+    wait_for_page_settled(driver)
+
+    if capture and capture.poll() is not None:
+        return
+
+    update_status_step("点击快速开始")
+    try:
+        quick_start_button = wait.until(
+            EC.element_to_be_clickable((By.XPATH, "//div[contains(text(), '快速开始')]"))
+        )
+        quick_start_button.click()
+        wait_for_page_settled(driver)
+    except TimeoutException:
+        logger.warning("点击快速开始按钮超时，直接访问邀请码页面")
+        driver.get(COZE_INVITE_URL)
+        wait_for_ready_state(driver, wait)
+        wait_for_page_settled(driver)
+    except Exception as e:
+        logger.warning(f"点击快速开始按钮失败: {str(e)}，尝试直接访问邀请码页面")
+        driver.get(COZE_INVITE_URL)
+        wait_for_ready_state(driver, wait)
+        wait_for_page_settled(driver)
+
+def resume_session(driver, wait):
+    """直接打开邀请码页面，返回当前登录态是否有效"""
+    update_status_step("打开邀请码页面")
+    driver.get(COZE_INVITE_URL)
+    wait_for_ready_state(driver, wait)
+    wait_for_page_settled(driver)
+    if check_logged_in(driver):
+        logger.info("登录态有效，跳过登录")
+        return True
+    logger.info("登录态已失效，需要重新登录")
+    return False
+
+# 登录会话缓存配置
+SESSION_DIR = "data/sessions"
+SESSION_TTL_HOURS = float(os.getenv("SESSION_TTL_HOURS", "72"))  # 保存的登录会话有效期
+
+# 登录会话缓存命中统计，hits为跳过登录的次数，misses为执行完整登录的次数，direct为不启动浏览器直接请求接口的次数
+session_cache_stats = {"hits": 0, "misses": 0, "rejected": 0, "direct": 0}
+session_stats_lock = Lock()
+
+# CDP Network.setCookies 接受的 Cookie 字段
+SESSION_COOKIE_FIELDS = ("name", "value", "domain", "path", "secure", "httpOnly", "sameSite", "expires")
+
+def record_session_stat(key):
+    with session_stats_lock:
+        session_cache_stats[key] += 1
+    touch_update_status()
+
+def get_session_path(account_id):
+    """账号对应的会话文件路径，文件名使用账号哈希避免明文暴露账号"""
+    digest = hashlib.sha256(account_id.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(SESSION_DIR, f"{digest}.json")
+
+def load_session(account_id):
+    """读取未过期的登录会话，不存在或已过期时返回None"""
+    path = get_session_path(account_id)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            session = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    if session.get("expires_at", 0) <= time.time():
+        logger.info("保存的登录会话已过期")
+        clear_session(account_id)
+        return None
+    return session
+
+def save_session(driver, account_id):
+    """保存当前浏览器的Cookie和localStorage，供下次刷新时恢复"""
+    try:
+        cookies = driver.execute_cdp_cmd("Network.getAllCookies", {}).get("cookies", [])
+        local_storage = driver.execute_script("""
+            const items = {};
+            for (let i = 0; i < localStorage.length; i++) {
+                const key = localStorage.key(i);
+                items[key] = localStorage.getItem(key);
+            }
+            return {origin: location.origin, items: items};
+        """)
+        session = {
+            "cookies": cookies,
+            "local_storage": [local_storage] if local_storage else [],
+            "invite_api": captured_invite_endpoints.get(account_id),
+            "saved_at": time.time(),
+            "expires_at": time.time() + SESSION_TTL_HOURS * 3600
+        }
+
+        os.makedirs(SESSION_DIR, exist_ok=True)
+        path = get_session_path(account_id)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(session, f, ensure_ascii=False)
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, path)
+        logger.info(f"已保存登录会话，共 {len(cookies)} 个Cookie")
+    except Exception as e:
+        logger.warning(f"保存登录会话失败: {str(e)}")
+
+def clear_session(account_id):
+    try:
+        os.remove(get_session_path(account_id))
+    except FileNotFoundError:
+        pass
+
+def restore_session(driver, session):
+    """在打开页面之前注入保存的Cookie和localStorage，返回注入脚本的标识"""
+    update_status_step("恢复登录会话")
+    cookies = []
+    for cookie in session.get("cookies", []):
+        param = {k: cookie[k] for k in SESSION_COOKIE_FIELDS if k in cookie}
+        # 会话Cookie的expires为-1，不能原样传回
+        if cookie.get("session") or param.get("expires", -1) < 0:
+            param.pop("expires", None)
+        cookies.append(param)
+
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setCookies", {"cookies": cookies})
+
+    # localStorage只能在对应源的页面中写入，通过新文档脚本在页面脚本执行前注入
+    script = """
+        (function(stores) {
+            for (const store of stores) {
+                if (store.origin !== location.origin) continue;
+                for (const [key, value] of Object.entries(store.items)) {
+                    if (localStorage.getItem(key) === null) localStorage.setItem(key, value);
+                }
+            }
+        })(%s);
+    """ % json.dumps(session.get("local_storage", []))
+    result = driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": script})
+    return result.get("identifier")
+
+def login_with_saved_session(driver, wait, account_id):
+    """尝试用保存的会话登录，会话不存在或被拒绝时返回False"""
+    session = load_session(account_id)
+    if not session:
+        return False
+
+    script_id = restore_session(driver, session)
+    try:
+        if resume_session(driver, wait):
+            return True
+    finally:
+        if script_id:
+            try:
+                driver.execute_cdp_cmd("Page.removeScriptToEvaluateOnNewDocument", {"identifier": script_id})
+            except Exception:
+                pass
+
+    logger.info("保存的登录会话被拒绝，执行完整登录")
+    record_session_stat("rejected")
+    clear_session(account_id)
+    driver.delete_all_cookies()
+    return False
+
+# 不启动浏览器的刷新：用保存的会话Cookie直接请求捕获到的邀请码接口，浏览器只负责登录和续期会话
+DIRECT_REFRESH_ENABLED = os.getenv("DIRECT_REFRESH_ENABLED", "true").lower() == "true"
+DIRECT_REFRESH_TIMEOUT = float(os.getenv("DIRECT_REFRESH_TIMEOUT", "10"))  # 直接请求接口的超时时间（秒）
+INVITE_API_URL = os.getenv("INVITE_API_URL")  # 手动指定邀请码接口，优先于捕获到的地址
+INVITE_API_BASE_URL = os.getenv("INVITE_API_BASE_URL")  # 替换接口地址的协议和主机，用于指向本地测试服务
+
+http_pool = urllib3.PoolManager(
+    num_pools=4,
+    maxsize=4,
+    retries=False,
+    timeout=urllib3.Timeout(connect=5, read=DIRECT_REFRESH_TIMEOUT)
+)
+
+def build_cookie_header(cookies, url):
+    """按域名、路径和过期时间挑选发送给接口的Cookie"""
+    parts = urlsplit(url)
+    host = parts.hostname or ""
+    path = parts.path or "/"
+    now = time.time()
+    pairs = []
+    for cookie in cookies:
+        domain = cookie.get("domain", "").lstrip(".")
+        if not domain or not (host == domain or host.endswith("." + domain)):
+            continue
+        if not path.startswith(cookie.get("path") or "/"):
+            continue
+        if cookie.get("secure") and parts.scheme != "https":
+            continue
+        expires = cookie.get("expires", -1)
+        if not cookie.get("session") and 0 < expires < now:
+            continue
+        pairs.append(f"{cookie['name']}={cookie['value']}")
+    return "; ".join(pairs)
+
+def get_invite_api(account_id, session):
+    """邀请码接口地址，返回 {"url", "method", "body"}，没有可用接口时返回None"""
+    if INVITE_API_URL:
+        return {"url": INVITE_API_URL, "method": "GET", "body": None}
+    endpoint = captured_invite_endpoints.get(account_id) or session.get("invite_api")
+    if endpoint:
+        captured_invite_endpoints.setdefault(account_id, endpoint)
+    return endpoint
+
+def fetch_invite_codes_direct(account_id):
+    """用保存的会话直接请求邀请码接口，会话或接口不可用时返回None，由浏览器重新获取"""
+    if not DIRECT_REFRESH_ENABLED:
+        return None
+    session = load_session(account_id)
+    if not session:
+        return None
+    endpoint = get_invite_api(account_id, session)
+    if not endpoint:
+        return None
+
+    update_status_step("直接请求邀请码接口")
+    # Cookie按原接口地址匹配，INVITE_API_BASE_URL只改变实际请求的地址
+    url = endpoint["url"]
+    if INVITE_API_BASE_URL:
+        parts = urlsplit(url)
+        url = INVITE_API_BASE_URL.rstrip("/") + urlunsplit(("", "", parts.path, parts.query, ""))
+
+    headers = {
+        "User-Agent": CHROME_USER_AGENT,
+        "Accept": "application/json, text/plain, */*",
+        "Referer": COZE_INVITE_URL,
+        "Cookie": build_cookie_header(session.get("cookies", []), endpoint["url"])
+    }
+    if endpoint.get("body"):
+        headers["Content-Type"] = "application/json"
+
+    try:
+        response = http_pool.request(endpoint.get("method", "GET"), url, body=endpoint.get("body"), headers=headers)
+    except urllib3.exceptions.HTTPError as e:
+        logger.warning(f"直接请求邀请码接口失败: {str(e)}")
+        return None
+
+    if response.status in (401, 403):
+        logger.info("接口拒绝了保存的登录会话，使用浏览器重新登录")
+        return None
+    if response.status != 200:
+        logger.warning(f"邀请码接口返回状态码 {response.status}，改用浏览器获取")
+        return None
+
+    try:
+        codes = parse_invite_codes_json(json.loads(response.data.decode("utf-8")))
+    except ValueError:
+        codes = None
+    if not codes:
+        # 登录失效时接口通常仍返回200，但不再包含邀请码
+        logger.info("接口响应中没有邀请码，使用浏览器重新获取")
+        return None
+
+    record_session_stat("direct")
+    logger.info(f"直接请求接口获取到 {len(codes)} 个邀请码")
+    return codes
+
+def extract_invite_codes(driver, wait, capture=None):
+    """从邀请码页面提取邀请码列表，优先使用捕获到的接口响应"""
+    if capture:
+        codes = capture.poll()
+        if codes is not None:
+            update_status_step("读取邀请码接口")
+            return codes
+
+    update_status_step("点击立即邀请")
+    try:
+        invite_now_button = wait.until(
+            EC.element_to_be_clickable((By.XPATH, "//button[contains(text(), '立即邀请')]"))
+        )
+        invite_now_button.click()
+    except Exception as e:
+        logger.warning(f"点击立即邀请按钮失败: {str(e)}")
+        # 可能已经在邀请码页面
+        pass
+
+    if capture:
+        update_status_step("等待邀请码接口")
+        codes = capture.wait()
+        if codes is not None:
+            return codes
+        if SCRAPE_CAPTURE_MODE == "network":
+            raise Exception("未捕获到邀请码接口响应")
+        logger.info("未捕获到邀请码接口响应，改为解析页面")
+
+    update_status_step("获取邀请码信息")
+    # 等待邀请码元素出现并且列表渲染稳定
+    try:
+        WebDriverWait(driver, 15).until(
+            EC.presence_of_element_located((By.CSS_SELECTOR, 'div[class*="invite-code"]'))
+        )
+    except TimeoutException:
+        logger.warning("等待邀请码元素出现超时")
+    wait_for_page_settled(driver)
+
+    # 首先尝试使用 JavaScript 方法获取
+    codes = []
+    try:
+        elements = driver.execute_script("""
+            return Array.from(document.querySelectorAll(".invite-code-item")).map(el => el.innerText);
+        """)
+
+        if elements:
+            logger.info("使用 JavaScript 方法获取邀请码")
+            for element_text in elements:
+                try:
+                    # 使用安全解析函数
+                    code, status = parse_invite_code_text(element_text)
+                    if code:
+                        logger.info(f'邀请码: {code}, 状态: {status}')
+                        codes.append({
+                            'code': code.strip(),
+                            'status': status.strip()
+                        })
+                except Exception as e:
+                    logger.error(f'处理邀请码文本时出错: {str(e)}')
+    except Exception as e:
+        logger.warning(f'JavaScript 方法获取失败，尝试备用方法: {str(e)}')
+
+    # 如果 JavaScript 方法没有获取到数据，使用 Selenium 方法
+    if not codes:
+        logger.info("使用 Selenium 方法获取邀请码")
+        # 等待邀请码容器出现
+        try:
+            wait.until(
+                EC.presence_of_element_located((By.CSS_SELECTOR, 'div[class*="invite-code"]'))
+            )
+
+            # 获取所有邀请码容器
+            invite_containers = driver.find_elements(By.CSS_SELECTOR, 'div[class*="invite-code"]')
+            logger.info(f'找到 {len(invite_containers)} 个邀请码容器')
+
+            for container in invite_containers:
+                try:
+                    # 使用 JavaScript 滚动到元素位置
+                    driver.execute_script("arguments[0].scrollIntoView(true);", container)
+                    try:
+                        # 等待滚动后的内容渲染出文本
+                        WebDriverWait(driver, 2, poll_frequency=0.05).until(lambda _: container.text.strip())
+                    except TimeoutException:
+                        pass
+
+                    # 尝试不同的选择器组合
+                    selectors = [
+                        ('.items-center.coz-fg-plus', 'div > div > div > div:nth-child(2) > div > span'),
+                        ('div[class*="invite-code"] > div.coz-fg-plus', 'div[class*="invite-code"] > div > button > div > span')
+                    ]
+
+                    for code_selector, status_selector in selectors:
+                        try:
+                            code_element = container.find_element(By.CSS_SELECTOR, code_selector)
+                            status_element = container.find_element(By.CSS_SELECTOR, status_selector)
+                            code = code_element.text.strip()
+                            status = status_element.text.strip()
+                            if code:  # 只要有code就添加，不强制要求status
+                                codes.append({
+                                    'code': code,
+                                    'status': status if status else "未知状态"
+                                })
+                                break
+                        except:
+                            continue
+
+                except Exception as e:
+                    logger.error(f'处理邀请码元素时出错: {str(e)}')
+                    continue
+        except Exception as e:
+            logger.error(f'定位邀请码容器时出错: {str(e)}')
+            # 保存截图记录页面状态
+            screenshot_path = f"error_invite_codes_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
+            driver.save_screenshot(screenshot_path)
+            metrics.inc("coze_screenshots_total", {"kind": "invite_codes"})
+            logger.info(f"已保存邀请码页面错误截图到 {screenshot_path}")
+
+    if not codes:
+        logger.warning("未找到任何邀请码")
+
+    return codes
+
+# 获取邀请码
+def get_invite_codes(account_id, password):
+    """用浏览器抓取邀请码，WebDriver出错时由retry重试，重试后仍然失败时统一转换为HTTPException"""
+    try:
+        return scrape_with_browser(account_id, password)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"获取邀请码过程中出错: {str(e)}")
+
+@retry(max_tries=3, delay_seconds=5)
+def scrape_with_browser(account_id, password):
+    # 从浏览器池借用该账号的常驻浏览器，出错时浏览器会被销毁，下次重试使用新实例
+    with browser_pool.borrow(account_id) as browser:
+        driver = browser["driver"]
+        try:
+            wait = WebDriverWait(driver, 30)
+            capture = InviteCodeCapture(driver, account_id) if SCRAPE_CAPTURE_MODE != "dom" else None
+
+            if (browser["logged_in"] and resume_session(driver, wait)) or login_with_saved_session(driver, wait, account_id):
+                record_session_stat("hits")
+            else:
+                record_session_stat("misses")
+                browser["logged_in"] = False
+                login_account(driver, wait, account_id, password, capture)
+            browser["logged_in"] = True
+
+            codes = extract_invite_codes(driver, wait, capture)
+            # 每次成功后刷新保存的会话，延长有效期
+            save_session(driver, account_id)
+            finish_status_step()
+            return codes
+
+        except Exception as e:
+            error_msg = f"获取邀请码过程中出错: {str(e)}"
+            logger.error(error_msg)
+            # 捕获异常后尝试保存截图
+            try:
+                screenshot_path = f"error_exception_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
+                driver.save_screenshot(screenshot_path)
+                metrics.inc("coze_screenshots_total", {"kind": "exception"})
+                logger.info(f"已保存异常时截图到 {screenshot_path}")
+            except:
+                pass
+            # 保留原始异常，WebDriverException / TimeoutException 交给retry重试
+            raise
+
+        finally:
+            finish_status_step()
+
+# 修改 load_data 函数
+def load_data():
+    try:
+        with open(DATA_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+            return data
+    except FileNotFoundError:
+        return {"codes": [], "last_update": None, "next_update": None}
+
+# 修改 save_data 函数
+def save_data(data):
+    """原子写入完整数据快照：先写临时文件并落盘，再替换正式文件"""
+    tmp_path = f"{DATA_FILE}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, DATA_FILE)
+    invalidate_cache()  # 保存数据时使缓存失效
+
+# 数据变更日志配置
+JOURNAL_FILE = "data/journal.log"
+COMPACT_INTERVAL = int(os.getenv("COMPACT_INTERVAL", "300"))  # 定期压缩日志的间隔（秒）
+COMPACT_MAX_ENTRIES = int(os.getenv("COMPACT_MAX_ENTRIES", "1000"))  # 日志条数超过该值时提前压缩
+
+def apply_journal_record(data, record):
+    """把一条变更记录应用到数据上，所有操作都是幂等的，可以重复回放"""
+    op = record.get("op")
+    if op == "activate":
+        for item in data["codes"]:
+            if item["code"] == record["code"] and item.get("source", "未知") == record["source"]:
+                item["status"] = "已激活"
+    elif op == "activate_many":
+        keys = {(code, source) for code, source in record["codes"]}
+        for item in data["codes"]:
+            if (item["code"], item.get("source", "未知")) in keys:
+                item["status"] = "已激活"
+    elif op == "snapshot":
+        data["codes"] = [item for item in data["codes"] if item.get("source") != record["source"]] + record["codes"]
+        data["last_update"] = record["last_update"]
+    elif op == "merge":
+        source = record["source"]
+        removes = set(record["removes"])
+        codes = [item for item in data["codes"] if not (item.get("source", "未知") == source and item["code"] in removes)]
+        index = {(item["code"], item.get("source", "未知")): item for item in codes}
+        for row in record["upserts"]:
+            key = (row["code"], row["source"])
+            if key in index:
+                index[key].update(row)
+            else:
+                index[key] = dict(row)
+                codes.append(index[key])
+        # 本次抓取中出现的条目就是该来源剩下的全部条目
+        for item in codes:
+            if item.get("source", "未知") == source:
+                item["last_seen"] = record["seen_at"]
+        data["codes"] = codes
+        data["last_update"] = record["last_update"]
+    elif op == "meta":
+        data.update(record["values"])
+    else:
+        logger.warning(f"忽略未知的日志记录: {op}")
+
+class DataJournal:
+    """追加写入的数据变更日志，启动时在数据快照上回放，压缩时写入新快照并清空"""
+
+    def __init__(self, path):
+        self.path = path
+        self.rotated_path = f"{path}.1"
+        self.entries = 0
+        self._lock = Lock()
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n"
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self.entries += 1
+
+    def replay(self, data):
+        """在快照数据上回放日志，忽略崩溃时写了一半的最后一行"""
+        data.setdefault("codes", [])
+        count = 0
+        for path in (self.rotated_path, self.path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    lines = f.readlines()
+            except FileNotFoundError:
+                continue
+            if lines and not lines[-1].endswith("\n"):
+                # 截掉写了一半的最后一行，避免后续追加的记录接在它后面
+                with open(path, 'rb+') as f:
+                    f.truncate(os.path.getsize(path) - len(lines[-1].encode('utf-8')))
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"跳过损坏的日志记录: {line[:100]!r}")
+                    continue
+                apply_journal_record(data, record)
+                count += 1
+        if count:
+            logger.info(f"已回放 {count} 条数据变更日志")
+        self.entries = count
+        return data
+
+    def rotate(self):
+        """把当前日志改名，之后的变更写入新日志，返回是否有需要压缩的内容"""
+        with self._lock:
+            if os.path.exists(self.path):
+                if os.path.exists(self.rotated_path):
+                    # 上一次压缩没有完成，旧日志中的记录还不在快照里，追加而不是覆盖
+                    self._append_to_rotated()
+                else:
+                    os.replace(self.path, self.rotated_path)
+            self.entries = 0
+            return os.path.exists(self.rotated_path)
+
+    def _append_to_rotated(self):
+        with open(self.path, 'rb') as f:
+            content = f.read()
+        with open(self.rotated_path, 'ab+') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # 崩溃时写了一半的最后一行单独成行，回放时会被跳过
+                    f.write(b"\n")
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.remove(self.path)
+
+    def discard_rotated(self):
+        try:
+            os.remove(self.rotated_path)
+        except FileNotFoundError:
+            pass
+
+# 存储后端配置：json（默认，数据快照+变更日志）或 sqlite
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+SQLITE_FILE = os.getenv("SQLITE_FILE", "data/data.db")
+
+class JsonStorage:
+    """JSON快照加追加日志的存储后端"""
+
+    def __init__(self, data_file, journal_file):
+        self.data_file = data_file
+        self.journal = DataJournal(journal_file)
+        self._own_stamp = None  # 本进程最近一次写入后的文件状态
+
+    @property
+    def pending_changes(self):
+        return self.journal.entries
+
+    def load(self):
+        return self.journal.replay(load_data())
+
+    def record(self, record):
+        self.journal.append(record)
+        self._own_stamp = self._file_stamp()
+
+    def activate(self, code, source):
+        """记录一次发放，JSON后端只有本进程在写，总是成功"""
+        self.journal.append({"op": "activate", "code": code, "source": source, "ts": time.time()})
+        self._own_stamp = self._file_stamp()
+        return True
+
+    def activate_many(self, keys):
+        """一次写入一批发放记录，返回成功发放的 (邀请码, 来源) 列表"""
+        self.journal.append({"op": "activate_many", "codes": [list(key) for key in keys], "ts": time.time()})
+        self._own_stamp = self._file_stamp()
+        return list(keys)
+
+    def begin_compact(self):
+        rotated = self.journal.rotate()
+        # 改名日志也是本进程的写入，不能被当成其他进程的变更
+        self._own_stamp = self._file_stamp()
+        return rotated
+
+    def finish_compact(self, data):
+        save_data(data)
+        self.journal.discard_rotated()
+        self._own_stamp = self._file_stamp()
+
+    def _file_stamp(self):
+        stamp = []
+        for path in (self.data_file, self.journal.path):
+            try:
+                st = os.stat(path)
+                stamp.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def change_stamp(self):
+        """数据文件的变更戳，本进程最近一次写入后没有变化时返回None"""
+        stamp = self._file_stamp()
+        return None if stamp == self._own_stamp else stamp
+
+class SqliteStorage:
+    """SQLite存储后端（WAL模式），邀请码和发放记录分表存储并建立索引"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS codes (
+            code TEXT NOT NULL,
+            source TEXT NOT NULL,
+            status TEXT NOT NULL,
+            first_seen TEXT NOT NULL,
+            last_seen TEXT NOT NULL,
+            PRIMARY KEY (code, source)
+        );
+        CREATE INDEX IF NOT EXISTS idx_codes_status ON codes (status, source);
+        CREATE TABLE IF NOT EXISTS dispense_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT NOT NULL,
+            source TEXT NOT NULL,
+            dispensed_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_dispense_events_code ON dispense_events (code, source);
+        CREATE INDEX IF NOT EXISTS idx_dispense_events_time ON dispense_events (dispensed_at);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    pending_changes = 0
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def load(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT code, status, source, first_seen, last_seen FROM codes ORDER BY rowid"
+            ).fetchall()
+            meta = dict(self._conn.execute("SELECT key, value FROM meta").fetchall())
+
+        if not rows and not meta:
+            # 首次启用SQLite时从JSON数据迁移
+            data = JsonStorage(DATA_FILE, JOURNAL_FILE).load()
+            if data.get("codes"):
+                logger.info(f"从JSON数据迁移 {len(data['codes'])} 个邀请码到SQLite")
+                with self._transaction() as conn:
+                    for item in data["codes"]:
+                        self._upsert_code(conn, item, data.get("last_update") or datetime.now().isoformat())
+                    self._set_meta(conn, {k: v for k, v in data.items() if k != "codes"})
+            return data
+
+        data = {key: json.loads(value) for key, value in meta.items()}
+        data["codes"] = [
+            {"code": code, "status": status, "source": source, "first_seen": first_seen, "last_seen": last_seen}
+            for code, status, source, first_seen, last_seen in rows
+        ]
+        return data
+
+    def _upsert_code(self, conn, item, seen_at):
+        # 已经发放（可能由其他进程发放）的邀请码不会被抓取到的“未激活”状态覆盖
+        conn.execute(
+            """INSERT INTO codes (code, source, status, first_seen, last_seen) VALUES (?, ?, ?, ?, ?)
+               ON CONFLICT (code, source) DO UPDATE SET
+                   status = CASE WHEN codes.status LIKE '%已激活%' AND excluded.status LIKE '%未激活%'
+                                 THEN codes.status ELSE excluded.status END,
+                   last_seen = excluded.last_seen""",
+            (item["code"], item.get("source", "未知"), item.get("status", ""), item.get("first_seen") or seen_at, seen_at)
+        )
+
+    def _set_meta(self, conn, values):
+        conn.executemany(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            [(key, json.dumps(value, ensure_ascii=False)) for key, value in values.items()]
+        )
+
+    def record(self, record):
+        op = record.get("op")
+        with self._transaction() as conn:
+            if op == "merge":
+                source = record["source"]
+                seen_at = record["seen_at"]
+                conn.executemany(
+                    "DELETE FROM codes WHERE code = ? AND source = ?",
+                    [(code, source) for code in record["removes"]]
+                )
+                for item in record["upserts"]:
+                    self._upsert_code(conn, item, seen_at)
+                conn.execute("UPDATE codes SET last_seen = ? WHERE source = ? AND last_seen <> ?", (seen_at, source, seen_at))
+                self._set_meta(conn, {"last_update": record["last_update"]})
+            elif op == "meta":
+                self._set_meta(conn, record["values"])
+            else:
+                logger.warning(f"忽略未知的变更记录: {op}")
+
+    def activate(self, code, source):
+        """在一个事务中把未激活的邀请码标记为已激活并写入发放记录，已被其他进程发放时返回False"""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE codes SET status = '已激活' WHERE code = ? AND source = ? AND status LIKE '%未激活%'",
+                (code, source)
+            )
+            if cursor.rowcount != 1:
+                return False
+            conn.execute(
+                "INSERT INTO dispense_events (code, source, dispensed_at) VALUES (?, ?, ?)",
+                (code, source, datetime.now().isoformat())
+            )
+            return True
+
+    def activate_many(self, keys):
+        """在一个事务中发放一批邀请码，返回成功发放的 (邀请码, 来源) 列表，已被其他进程发放的被跳过"""
+        dispensed_at = datetime.now().isoformat()
+        activated = []
+        with self._transaction() as conn:
+            for code, source in keys:
+                cursor = conn.execute(
+                    "UPDATE codes SET status = '已激活' WHERE code = ? AND source = ? AND status LIKE '%未激活%'",
+                    (code, source)
+                )
+                if cursor.rowcount == 1:
+                    activated.append((code, source))
+            conn.executemany(
+                "INSERT INTO dispense_events (code, source, dispensed_at) VALUES (?, ?, ?)",
+                [(code, source, dispensed_at) for code, source in activated]
+            )
+        return activated
+
+    def change_stamp(self):
+        """PRAGMA data_version 只在其他连接（其他进程）提交后变化"""
+        with self._lock:
+            return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def begin_compact(self):
+        # WAL由SQLite自动检查点，不需要额外压缩
+        return False
+
+    def finish_compact(self, data):
+        pass
+
+def create_storage():
+    if STORAGE_BACKEND == "sqlite":
+        logger.info(f"使用SQLite存储: {SQLITE_FILE}")
+        return SqliteStorage(SQLITE_FILE)
+    if STORAGE_BACKEND != "json":
+        logger.warning(f"未知的存储后端 {STORAGE_BACKEND}，使用JSON存储")
+    return JsonStorage(DATA_FILE, JOURNAL_FILE)
+
+class CodeInventory:
+    """常驻内存的邀请码库存，按 (邀请码, 来源) 建立索引，未激活的邀请码按来源排队发放"""
+
+    def __init__(self, data=None, storage=None):
+        self._lock = Lock()
+        self._compact_lock = Lock()
+        self.storage = storage
+        self.version = 0
+        self.modified_at = time.time()
+        self.load(data or {})
+
+    def load(self, data):
+        """用完整数据替换当前库存"""
+        with self._lock:
+            self._load_locked(data)
+
+    def reload(self):
+        """从存储重新加载库存，读取和替换都在库存锁内完成，读取期间的发放不会被旧数据覆盖"""
+        with self._lock:
+            self._load_locked(self.storage.load())
+
+    def _load_locked(self, data):
+        self._meta = {k: v for k, v in data.items() if k != "codes"}
+        self._meta.setdefault("last_update", None)
+        self._meta.setdefault("next_update", None)
+        self._rebuild_locked([dict(item) for item in data.get("codes", [])])
+
+    def _touch_locked(self):
+        self.version += 1
+        self.modified_at = time.time()
+        event_broadcaster.publish("codes")
+
+    def version_info(self):
+        """返回 (版本号, 修改时间)"""
+        with self._lock:
+            return self.version, self.modified_at
+
+    def _rebuild_locked(self, codes):
+        self._touch_locked()
+        self._index = {}
+        self._queues = {}
+        for item in codes:
+            key = (item["code"], item.get("source", "未知"))
+            self._index[key] = item
+            if "未激活" in item.get("status", ""):
+                self._queues.setdefault(key[1], deque()).append(key)
+
+    def snapshot(self):
+        """返回库存数据的副本，格式与 data.json 一致"""
+        with self._lock:
+            data = dict(self._meta)
+            data["codes"] = [dict(item) for item in self._index.values()]
+            return data
+
+    def _record_locked(self, record):
+        # 在库存锁内写入存储，保证持久化顺序与内存中的变更顺序一致
+        if self.storage is not None:
+            self.storage.record(record)
+        self._touch_locked()
+
+    def merge_source(self, source, codes, update_time):
+        """把某个账号新抓取的邀请码按 (邀请码, 来源) 合并进库存，返回 (新增或变化的条数, 删除的条数)
+
+        本地已经发放、Coze还没有标记为已使用的邀请码保持已激活；这次没有抓到的邀请码被删除；
+        只把变化的条目写入存储，写入量与变化量成正比
+        """
+        with self._lock:
+            scraped = {}
+            for item in codes:
+                scraped[(item["code"], source)] = item.get("status", "")
+
+            removes = [key for key in self._index if key[1] == source and key not in scraped]
+            stale = bool(removes)  # 是否有条目离开了发放队列
+            for key in removes:
+                del self._index[key]
+
+            upserts = []
+            for key, status in scraped.items():
+                current = self._index.get(key)
+                if current is None:
+                    current = self._index[key] = {
+                        "code": key[0],
+                        "status": status,
+                        "source": source,
+                        "first_seen": update_time,
+                        "last_seen": update_time
+                    }
+                    upserts.append(dict(current))
+                    if "未激活" in status:
+                        self._queues.setdefault(source, deque()).append(key)
+                    continue
+
+                current["last_seen"] = update_time
+                if "已激活" in current.get("status", "") and "未激活" in status:
+                    # 本地已经发放，Coze的状态还没有更新
+                    continue
+                if status != current.get("status"):
+                    was_available = "未激活" in current.get("status", "")
+                    current["status"] = status
+                    upserts.append(dict(current))
+                    if "未激活" in status and not was_available:
+                        self._queues.setdefault(source, deque()).append(key)
+                    elif was_available and "未激活" not in status:
+                        stale = True
+
+            if stale and source in self._queues:
+                # 删除或不再可用的条目同时移出队列，保证队列长度就是可发放的数量
+                self._queues[source] = deque(
+                    key for key in self._queues[source]
+                    if key in self._index and "未激活" in self._index[key].get("status", "")
+                )
+
+            self._meta["last_update"] = update_time
+            self._record_locked({
+                "op": "merge",
+                "source": source,
+                "seen_at": update_time,
+                "upserts": upserts,
+                "removes": [code for code, _ in removes],
+                "last_update": update_time
+            })
+            return len(upserts), len(removes)
+
+    def set_meta(self, **kwargs):
+        with self._lock:
+            self._meta.update(kwargs)
+            self._record_locked({"op": "meta", "values": kwargs})
+
+    def available_count(self, source=None):
+        """未激活邀请码数量"""
+        with self._lock:
+            if source is not None:
+                return len(self._queues.get(source, ()))
+            return sum(len(queue) for queue in self._queues.values())
+
+    def available_by_source(self):
+        with self._lock:
+            return {source: len(queue) for source, queue in self._queues.items()}
+
+    def _take_locked(self, source=None):
+        """从队列中取出一个未激活的条目并标记为已激活，没有可用条目时返回None"""
+        queues = [self._queues.get(source, ())] if source is not None else self._queues.values()
+        for queue in queues:
+            while queue:
+                item = self._index.get(queue.popleft())
+                # 跳过在排队期间状态已经变化的条目
+                if item is None or "未激活" not in item.get("status", ""):
+                    continue
+                code_data = {
+                    "code": item["code"],
+                    "status": item["status"],
+                    "source": item.get("source", "未知")
+                }
+                item["status"] = "已激活"
+                return code_data
+        return None
+
+    def dispense(self):
+        """取出一个未激活的邀请码并标记为已激活，没有可用邀请码时返回None"""
+        with self._lock:
+            while True:
+                code_data = self._take_locked()
+                if code_data is None:
+                    return None
+                self._touch_locked()
+                # 一次发放只写入一条记录，不再重写整个数据文件；被其他进程抢先发放时换下一个
+                if self.storage is not None and not self.storage.activate(code_data["code"], code_data["source"]):
+                    continue
+                return code_data
+
+    def dispense_many(self, count, source=None):
+        """一次取出最多count个未激活的邀请码并标记为已激活，只写入一次存储；可以只从指定来源发放
+
+        库存不足时返回能取到的全部邀请码
+        """
+        dispensed = []
+        with self._lock:
+            while len(dispensed) < count:
+                batch = []
+                while len(dispensed) + len(batch) < count:
+                    code_data = self._take_locked(source)
+                    if code_data is None:
+                        break
+                    batch.append(code_data)
+                if not batch:
+                    break
+                self._touch_locked()
+                if self.storage is None:
+                    dispensed.extend(batch)
+                    continue
+                # 被其他进程抢先发放的邀请码不计入结果，再从队列中补足
+                activated = set(self.storage.activate_many([(item["code"], item["source"]) for item in batch]))
+                dispensed.extend(item for item in batch if (item["code"], item["source"]) in activated)
+        return dispensed
+
+    def compact(self):
+        """把当前库存原子写入数据快照，并丢弃已经包含在快照中的日志"""
+        with self._compact_lock:
+            with self._lock:
+                if self.storage is None or not self.storage.begin_compact():
+                    return False
+                data = dict(self._meta)
+                data["codes"] = [dict(item) for item in self._index.values()]
+            self.storage.finish_compact(data)
+            logger.info("已压缩数据变更日志并写入快照")
+            return True
+
+storage = create_storage()
+inventory = CodeInventory(storage.load(), storage)
+
+def run_compactor():
+    """后台定期压缩数据变更日志，日志过多时提前压缩"""
+    last_compact = time.time()
     while True:
-        schedule.run_pending()
-        time.sleep(60)  # 将检查间隔从1秒改为60秒
+        time.sleep(5)
+        if storage.pending_changes >= COMPACT_MAX_ENTRIES or time.time() - last_compact >= COMPACT_INTERVAL:
+            try:
+                inventory.compact()
+            except Exception as e:
+                logger.error(f"压缩数据变更日志失败: {str(e)}")
+            last_compact = time.time()
+
+# 获取一个未激活的邀请码并将其状态修改为已激活
+def get_and_activate_invite_code():
+    code_data = inventory.dispense()
+    if code_data is None:
+        # 没有找到未激活的邀请码
+        return None
+
+    logger.info(f"邀请码 {code_data['code']} 已被激活")
+    return code_data
+
+def get_and_activate_invite_codes(count, source=None):
+    codes = inventory.dispense_many(count, source)
+    if codes:
+        logger.info(f"批量激活 {len(codes)} 个邀请码: {', '.join(item['code'] for item in codes)}")
+    return codes
+
+# 库存驱动的刷新调度配置
+STOCK_LOW_WATERMARK = int(os.getenv("STOCK_LOW_WATERMARK", "3"))  # 未激活邀请码低于该数量前提前刷新
+REFRESH_MIN_INTERVAL = float(os.getenv("REFRESH_MIN_INTERVAL", "5"))  # 两次刷新的最短间隔（分钟）
+REFRESH_MAX_INTERVAL = float(os.getenv("REFRESH_MAX_INTERVAL", "120"))  # 库存充足时的最长刷新间隔（分钟）
+CONSUMPTION_WINDOW = float(os.getenv("CONSUMPTION_WINDOW", "60"))  # 估算消耗速度的时间窗口（分钟）
+DEFAULT_REFRESH_DURATION = 120  # 还没有刷新耗时记录时假设的刷新耗时（秒）
+
+class StockForecaster:
+    """记录邀请码发放时间，估算消耗速度，预测库存何时会低于水位线"""
+
+    def __init__(self, window_minutes):
+        self.window = window_minutes * 60
+        self.started_at = time.time()
+        self._events = deque()
+        self._lock = Lock()
+
+    def record(self, count=1):
+        with self._lock:
+            self._events.append((time.time(), count))
+
+    def rate(self):
+        """最近时间窗口内的平均消耗速度（个/秒）"""
+        now = time.time()
+        with self._lock:
+            while self._events and now - self._events[0][0] > self.window:
+                self._events.popleft()
+            total = sum(count for _, count in self._events)
+        # 刚启动时窗口还没填满，按实际经过的时间计算，但至少按1分钟算避免偶发请求造成高估
+        elapsed = max(60, min(self.window, now - self.started_at))
+        return total / elapsed
+
+    def seconds_until_watermark(self, stock, watermark):
+        """按当前消耗速度，库存降到水位线还需要多少秒"""
+        if stock <= watermark:
+            return 0
+        rate = self.rate()
+        if rate <= 0:
+            return float("inf")
+        return (stock - watermark) / rate
+
+stock_forecaster = StockForecaster(CONSUMPTION_WINDOW)
+refresh_state = {"last_started": 0}
+
+def compute_next_refresh_delay(lead_time=None):
+    """根据库存和消耗速度计算下次刷新前的等待时间（秒）：
+    在预计库存跌破水位线之前留出一次刷新的耗时，库存充足时退避到最长间隔"""
+    stock = inventory.available_count()
+    lead_time = lead_time or update_status["last_duration"] or DEFAULT_REFRESH_DURATION
+    delay = stock_forecaster.seconds_until_watermark(stock, STOCK_LOW_WATERMARK) - lead_time
+    delay = max(REFRESH_MIN_INTERVAL * 60, min(REFRESH_MAX_INTERVAL * 60, delay))
+    logger.info(f"当前库存 {stock}，消耗速度 {stock_forecaster.rate() * 3600:.1f} 个/小时，"
+                f"下次刷新在 {delay / 60:.1f} 分钟后")
+    return delay
+
+def start_background_update():
+    """在后台触发一次刷新，不阻塞当前请求；不负责刷新的进程把请求转给负责刷新的进程"""
+    if coordinator.is_leader:
+        refresh_scheduler.request_refresh()
+    else:
+        coordinator.forward_refresh_request()
+
+def maybe_refresh_early():
+    """发放后检查预计库存，即将低于水位线时提前触发刷新，正在抓取的账号不会重复启动"""
+    if time.time() - refresh_state["last_started"] < REFRESH_MIN_INTERVAL * 60:
+        return False
+
+    stock = inventory.available_count()
+    lead_time = update_status["last_duration"] or DEFAULT_REFRESH_DURATION
+    if stock_forecaster.seconds_until_watermark(stock, STOCK_LOW_WATERMARK) > lead_time:
+        return False
+
+    logger.info(f"库存 {stock} 预计很快低于水位线 {STOCK_LOW_WATERMARK}，提前刷新")
+    start_background_update()
+    return True
+
+def refresh_when_empty():
+    """库存不足时触发刷新，距离上次开始刷新不到 REFRESH_MIN_INTERVAL 时不重复触发"""
+    if time.time() - refresh_state["last_started"] < REFRESH_MIN_INTERVAL * 60:
+        return False
+    start_background_update()
+    return True
+
+# 账号配置
+ACCOUNTS_FILE = os.getenv("ACCOUNTS_FILE", "data/accounts.json")
+SCRAPE_CONCURRENCY = int(os.getenv("SCRAPE_CONCURRENCY", "2"))  # 同时抓取的账号数量
+
+def load_accounts():
+    """读取账号列表，来源为环境变量 ACCOUNTn_ID/ACCOUNTn_PASSWORD 和账号文件"""
+    accounts = []
+    seen = set()
+
+    # 环境变量中的账号按编号排序，来源名称沿用"账号n"
+    numbers = sorted(int(m.group(1)) for m in (re.match(r"^ACCOUNT(\d+)_ID$", key) for key in os.environ) if m)
+    for n in numbers:
+        account_id = os.getenv(f"ACCOUNT{n}_ID")
+        password = os.getenv(f"ACCOUNT{n}_PASSWORD")
+        if account_id and password and account_id not in seen:
+            seen.add(account_id)
+            accounts.append({"id": account_id, "password": password, "source": f"账号{n}"})
+
+    # 账号文件格式: [{"id": "...", "password": "...", "name": "可选的来源名称"}]
+    try:
+        with open(ACCOUNTS_FILE, 'r', encoding='utf-8') as f:
+            file_accounts = json.load(f)
+    except FileNotFoundError:
+        file_accounts = []
+    except json.JSONDecodeError as e:
+        logger.error(f"账号文件 {ACCOUNTS_FILE} 格式错误: {str(e)}")
+        file_accounts = []
+
+    next_number = max(numbers, default=0) + 1
+    for item in file_accounts:
+        account_id = item.get("id")
+        password = item.get("password")
+        if not account_id or not password or account_id in seen:
+            continue
+        seen.add(account_id)
+        source = item.get("name") or f"账号{next_number}"
+        next_number += 1
+        accounts.append({"id": account_id, "password": password, "source": source})
+
+    return accounts
+
+def scrape_account(account):
+    """抓取单个账号的邀请码，并标记来源"""
+    step_context.account = account["source"]
+    try:
+        # 优先不启动浏览器直接请求接口，失败时才使用浏览器登录或续期会话
+        codes = fetch_invite_codes_direct(account["id"])
+        if codes is None:
+            codes = get_invite_codes(account["id"], account["password"])
+        return [{"code": code["code"], "status": code["status"], "source": account["source"]} for code in codes or []]
+    finally:
+        finish_status_step()
+        step_context.account = None
+
+# 账号刷新失败后的指数退避
+ACCOUNT_BACKOFF_BASE = int(os.getenv("ACCOUNT_BACKOFF_BASE", "60"))  # 第一次失败后的重试间隔（秒）
+ACCOUNT_BACKOFF_MAX = int(os.getenv("ACCOUNT_BACKOFF_MAX", "3600"))  # 最长重试间隔（秒）
+
+class AccountRefresher:
+    """每个账号独立刷新：成功后按库存节奏安排下次刷新，失败后指数退避，账号之间互不等待
+
+    库存中每个来源的数据就是该账号最近一次成功抓取的结果，抓取失败或没有抓到邀请码时保持不变
+    """
+
+    def __init__(self, max_workers):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scraper")
+        self.states = {}
+        self._lock = Lock()
+        self._round_started = None
+
+    def _state_locked(self, source):
+        return self.states.setdefault(source, {
+            "running": False,
+            "failures": 0,
+            "next_due": 0,
+            "last_success": None,
+            "last_error": None,
+            "last_duration": None
+        })
+
+    def dispatch(self, force=False):
+        """启动到期账号的抓取并立即返回启动的账号数；force为True时不等正常刷新时间，但仍遵守失败退避"""
+        accounts = load_accounts()
+        if not accounts:
+            logger.warning("未配置任何账号")
+            return 0
+
+        now = time.time()
+        due = []
+        with self._lock:
+            # 移除已经不在配置中的账号
+            configured = {account["source"] for account in accounts}
+            for source in [s for s, state in self.states.items() if s not in configured and not state["running"]]:
+                del self.states[source]
+            for account in accounts:
+                state = self._state_locked(account["source"])
+                if state["running"]:
+                    continue
+                if now < state["next_due"] and (state["failures"] or not force):
+                    continue
+                state["running"] = True
+                due.append(account)
+            new_round = bool(due) and self._round_started is None
+            if new_round:
+                self._round_started = time.perf_counter()
+
+        if new_round:
+            refresh_state["last_started"] = time.time()
+            set_update_status(is_updating=True, last_error=None, step_timings={})
+        if due:
+            logger.info(f"开始抓取 {len(due)} 个账号: {', '.join(account['source'] for account in due)}")
+        for account in due:
+            self.executor.submit(self._refresh_account, account)
+        return len(due)
+
+    def _refresh_account(self, account):
+        source = account["source"]
+        started = time.perf_counter()
+        update_time = datetime.now().isoformat()
+        error_msg = None
+        try:
+            codes = scrape_account(account)
+            if not codes:
+                # 没有抓到邀请码时保留上一次的数据，避免库存被清空
+                raise Exception("未获取到邀请码")
+            changed, removed = inventory.merge_source(source, codes, update_time)
+            # 立即把新邀请码分配给正在等待的请求
+            dispense_waiters.notify()
+            set_update_status(last_update_time=update_time)
+            logger.info(f"{source}获取到 {len(codes)} 个邀请码，{changed} 个新增或变化，{removed} 个已移除")
+        except Exception as e:
+            error_msg = f"{source}获取邀请码失败: {str(e)}"
+            logger.error(error_msg)
+            if not update_status["last_error"]:  # 保留第一个错误
+                set_update_status(last_error=error_msg)
+
+        duration = round(time.perf_counter() - started, 3)
+        # 成功后按库存和消耗速度安排下次刷新
+        delay = compute_next_refresh_delay(duration) if error_msg is None else None
+        with self._lock:
+            state = self._state_locked(source)
+            state["running"] = False
+            state["last_duration"] = duration
+            if error_msg is None:
+                state["failures"] = 0
+                state["last_success"] = update_time
+                state["last_error"] = None
+            else:
+                state["failures"] += 1
+                state["last_error"] = error_msg
+                delay = min(ACCOUNT_BACKOFF_MAX, ACCOUNT_BACKOFF_BASE * 2 ** (state["failures"] - 1))
+                logger.info(f"{source}连续失败 {state['failures']} 次，{delay} 秒后重试")
+            state["next_due"] = time.time() + delay
+            round_finished = self._round_started is not None and not any(s["running"] for s in self.states.values())
+            round_duration = round(time.perf_counter() - self._round_started, 3) if round_finished else None
+            if round_finished:
+                self._round_started = None
+
+        if round_finished:
+            logger.info(f"本次刷新耗时 {round_duration} 秒")
+            set_update_status(is_updating=False, current_step=None, last_duration=round_duration)
+            metrics.observe("coze_scrape_duration_seconds", round_duration)
+        self.publish_schedule()
+
+    def next_due(self):
+        """空闲账号中最早的下次刷新时间（秒级时间戳），没有空闲账号时返回None"""
+        with self._lock:
+            due = [state["next_due"] for state in self.states.values() if not state["running"]]
+        return min(due) if due else None
+
+    def publish_schedule(self):
+        """把最早的账号刷新时间作为下次更新时间，并唤醒调度任务"""
+        next_due = self.next_due()
+        if next_due is None:
+            return
+        next_update_timestamp = int(next_due * 1000)  # 转换为毫秒时间戳
+        inventory.set_meta(next_update=next_update_timestamp)
+        set_update_status(next_update_time=next_update_timestamp)
+        refresh_scheduler.reschedule()
+
+    def status(self):
+        with self._lock:
+            return {
+                source: {
+                    "running": state["running"],
+                    "failures": state["failures"],
+                    "next_refresh_time": int(state["next_due"] * 1000) if state["next_due"] else None,
+                    "last_success": state["last_success"],
+                    "last_error": state["last_error"],
+                    "last_duration": state["last_duration"]
+                }
+                for source, state in self.states.items()
+            }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+account_refresher = AccountRefresher(max(1, SCRAPE_CONCURRENCY))
+
+# 更新邀请码
+def update_invite_codes(force=False):
+    """启动到期账号的刷新，不等待抓取完成，返回启动的账号数"""
+    started = account_refresher.dispatch(force)
+    if not started:
+        logger.info("没有需要刷新的账号")
+    account_refresher.publish_schedule()
+    return started
+
+def build_status_payload():
+    return {
+        "is_updating": update_status["is_updating"],
+        "current_step": update_status["current_step"],
+        "last_update_time": update_status["last_update_time"],
+        "next_update_time": update_status["next_update_time"],
+        "last_error": update_status["last_error"],
+        "step_timings": dict(update_status["step_timings"]),
+        "last_duration": update_status["last_duration"],
+        "session_cache": dict(session_cache_stats),
+        "accounts": account_refresher.status() if coordinator.is_leader else dict(coordinator.remote_accounts)
+    }
+
+def build_invite_codes_payload():
+    payload = build_status_payload()
+    payload["codes"] = get_cached_data().get("codes", [])
+    return payload
+
+def get_invite_codes_entry():
+    data_version, data_modified_at = inventory.version_info()
+    version = (data_version, update_status_version["version"])
+    modified_at = max(data_modified_at, update_status_version["modified_at"])
+    return response_cache.get("invite_codes", version, modified_at, build_invite_codes_payload)
+
+def cached_json_response(request: Request, entry):
+    """返回预先序列化的响应，支持 If-None-Match / If-Modified-Since 条件请求"""
+    headers = {
+        "ETag": entry["etag"],
+        "Last-Modified": entry["last_modified"],
+        "Cache-Control": "no-cache"
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        if "*" in tags or entry["etag"] in tags or f"W/{entry['etag']}" in tags:
+            return Response(status_code=304, headers=headers)
+    else:
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+                if entry["modified_at"] <= since:
+                    return Response(status_code=304, headers=headers)
+            except (TypeError, ValueError):
+                pass
+
+    return Response(content=entry["body"], media_type="application/json", headers=headers)
+
+# 修改 API 端点
+@app.get("/api/codes")
+def get_codes(request: Request):
+    return cached_json_response(request, get_cached_entry())
+
+@app.get('/api/invite_codes')
+async def get_invite_codes_api(request: Request):
+    """获取邀请码数据"""
+    return cached_json_response(request, get_invite_codes_entry())
+
+@app.get('/api/events')
+async def events_stream(request: Request):
+    """以SSE推送更新状态和邀请码变化，连接建立时先推送一次完整数据"""
+    queue = event_broadcaster.subscribe()
+
+    async def stream():
+        try:
+            yield format_sse("invite_codes", get_invite_codes_entry()["body"].decode('utf-8'))
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                yield message
+        finally:
+            event_broadcaster.unsubscribe(queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+MAX_WAIT_SECONDS = int(os.getenv("MAX_WAIT_SECONDS", "120"))  # wait参数允许的最长等待时间（秒）
+
+class DispenseWaiters:
+    """库存为空时排队等待的请求，所有等待者共用一次刷新，新邀请码入库后按先来后到分配"""
+
+    def __init__(self):
+        self._loop = None
+        self._queue = deque()
+
+    def bind_loop(self, loop):
+        self._loop = loop
+
+    def __len__(self):
+        return len(self._queue)
+
+    async def wait(self, timeout):
+        """等待分配邀请码，超时返回None"""
+        loop = asyncio.get_running_loop()
+        self._loop = loop
+        future = loop.create_future()
+        self._queue.append(future)
+
+        # 请求一次刷新（多次请求会合并），正在抓取的账号不会重复启动
+        refresh_when_empty()
+
+        try:
+            return await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            if not future.done():
+                future.cancel()
+            try:
+                self._queue.remove(future)
+            except ValueError:
+                pass
+
+    def notify(self):
+        """有新邀请码入库时调用，可以在任意线程中调用"""
+        loop = self._loop
+        if loop is None or loop.is_closed() or not self._queue:
+            return
+        loop.call_soon_threadsafe(self._drain)
+
+    def _drain(self):
+        while self._queue:
+            future = self._queue[0]
+            if future.done():
+                self._queue.popleft()
+                continue
+            invite_code = get_and_activate_invite_code()
+            if invite_code is None:
+                break
+            self._queue.popleft()
+            stock_forecaster.record()
+            future.set_result(invite_code)
+
+dispense_waiters = DispenseWaiters()
+
+# 按客户端IP限制领取频率（令牌桶）
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_CAPACITY = float(os.getenv("RATE_LIMIT_CAPACITY", "3"))  # 每个IP最多连续领取的数量
+RATE_LIMIT_REFILL_SECONDS = float(os.getenv("RATE_LIMIT_REFILL_SECONDS", "3600"))  # 每恢复一次领取机会需要的时间（秒）
+RATE_LIMIT_EXEMPT_IPS = {ip.strip() for ip in os.getenv("RATE_LIMIT_EXEMPT_IPS", "").split(",") if ip.strip()}
+RATE_LIMIT_REMEMBER_HOURS = float(os.getenv("RATE_LIMIT_REMEMBER_HOURS", "24"))  # 记住每个IP上次领取的邀请码的时长
+RATE_LIMIT_PERSIST_INTERVAL = int(os.getenv("RATE_LIMIT_PERSIST_INTERVAL", "60"))  # 保存领取记录的间隔（秒）
+ACTIVATION_CODES_FILE = os.getenv("ACTIVATION_CODES_FILE", "activation_codes.json")
+
+class ClientRateLimiter:
+    """按客户端IP的令牌桶，查询和扣减都在内存中完成，定期把各IP的领取记录保存到 activation_codes.json
+
+    每个IP的令牌耗尽后，如果之前领取过邀请码，直接返回上次领取的邀请码，不再从库存发放
+    """
+
+    def __init__(self, path, capacity, refill_seconds):
+        self.path = path
+        self.capacity = capacity
+        self.refill_seconds = refill_seconds
+        self._clients = {}
+        self._lock = Lock()
+        self._dirty = False
+
+    def _refill_locked(self, ip, now):
+        client = self._clients.get(ip)
+        if client is None:
+            client = self._clients[ip] = {"tokens": self.capacity, "updated": now, "last_code": None}
+        elapsed = now - client["updated"]
+        if elapsed > 0:
+            client["tokens"] = min(self.capacity, client["tokens"] + elapsed / self.refill_seconds)
+            client["updated"] = now
+        return client
+
+    def acquire(self, ip, cost=1):
+        """尝试扣减cost个令牌，返回 (是否允许, 需要等待的秒数, 上次领取的邀请码)"""
+        if not RATE_LIMIT_ENABLED or ip in RATE_LIMIT_EXEMPT_IPS:
+            return True, 0, None
+        with self._lock:
+            client = self._refill_locked(ip, time.time())
+            if client["tokens"] >= cost:
+                client["tokens"] -= cost
+                self._dirty = True
+                return True, 0, None
+            retry_after = (cost - client["tokens"]) * self.refill_seconds
+            return False, retry_after, client["last_code"]
+
+    def refund(self, ip, cost):
+        """发放失败或不足时退回没有用掉的令牌"""
+        if not RATE_LIMIT_ENABLED or cost <= 0 or ip in RATE_LIMIT_EXEMPT_IPS:
+            return
+        with self._lock:
+            client = self._refill_locked(ip, time.time())
+            client["tokens"] = min(self.capacity, client["tokens"] + cost)
+            self._dirty = True
+
+    def remember(self, ip, invite_code):
+        """记住该IP最近一次领取的邀请码"""
+        if not RATE_LIMIT_ENABLED or ip in RATE_LIMIT_EXEMPT_IPS:
+            return
+        with self._lock:
+            client = self._refill_locked(ip, time.time())
+            client["last_code"] = {
+                "code": invite_code["code"],
+                "source": invite_code["source"],
+                "time": time.time()
+            }
+            self._dirty = True
+
+    def _read_entries(self):
+        """读取文件中格式正确的IP记录，返回 {ip: 记录}，文件不存在或损坏时返回空字典"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取领取记录失败: {str(e)}")
+            return {}
+        entries = data.get("user_ips") if isinstance(data, dict) else None
+        if not isinstance(entries, list):
+            return {}
+
+        clients = {}
+        for entry in entries:
+            client = self._parse_entry(entry)
+            if client is not None:
+                clients[entry["ip"]] = client
+            else:
+                logger.warning(f"跳过格式错误的领取记录: {str(entry)[:100]}")
+        return clients
+
+    def _parse_entry(self, entry):
+        """校验一条IP记录，格式错误时返回None"""
+        if not isinstance(entry, dict) or not isinstance(entry.get("ip"), str) or not entry["ip"]:
+            return None
+        try:
+            tokens = min(self.capacity, float(entry.get("tokens", self.capacity)))
+            updated = float(entry.get("updated", time.time()))
+        except (TypeError, ValueError):
+            return None
+        last_code = entry.get("last_code")
+        if last_code is not None:
+            try:
+                last_code = {
+                    "code": str(last_code["code"]),
+                    "source": str(last_code["source"]),
+                    "time": float(last_code["time"])
+                }
+            except (TypeError, KeyError, ValueError):
+                last_code = None
+        return {"tokens": tokens, "updated": updated, "last_code": last_code}
+
+    def load(self):
+        clients = self._read_entries()
+        with self._lock:
+            self._clients.update(clients)
+        logger.info(f"已加载 {len(clients)} 个IP的领取记录")
+
+    def save(self):
+        """清理已经恢复满令牌且超过记忆时长的IP，把其余记录原子写入文件"""
+        now = time.time()
+        expire_before = now - RATE_LIMIT_REMEMBER_HOURS * 3600
+        with self._lock:
+            if not self._dirty:
+                return False
+            for ip in list(self._clients):
+                client = self._refill_locked(ip, now)
+                last_code = client["last_code"]
+                if last_code is not None and last_code["time"] < expire_before:
+                    client["last_code"] = last_code = None
+                if last_code is None and client["tokens"] >= self.capacity:
+                    del self._clients[ip]
+            user_ips = [{"ip": ip, **client} for ip, client in self._clients.items()]
+            self._dirty = False
+
+        # 多进程部署时保留其他进程写入、本进程没有的IP记录
+        known = {entry["ip"] for entry in user_ips}
+        for ip, client in self._read_entries().items():
+            if ip in known:
+                continue
+            if (client["last_code"] or {}).get("time", 0) >= expire_before or client["updated"] >= expire_before:
+                user_ips.append({"ip": ip, **client})
+
+        data = {
+            "activation_codes": [
+                {"ip": entry["ip"], **entry["last_code"]} for entry in user_ips if entry["last_code"]
+            ],
+            "user_ips": user_ips
+        }
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=4)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"保存领取记录失败: {str(e)}")
+            with self._lock:
+                self._dirty = True
+            return False
+        return True
+
+    def run_persister(self):
+        """后台定期保存领取记录"""
+        while True:
+            time.sleep(RATE_LIMIT_PERSIST_INTERVAL)
+            try:
+                self.save()
+            except Exception as e:
+                logger.error(f"保存领取记录失败: {str(e)}")
+
+rate_limiter = ClientRateLimiter(ACTIVATION_CODES_FILE, RATE_LIMIT_CAPACITY, RATE_LIMIT_REFILL_SECONDS)
+
+def get_client_ip(request: Request):
+    # 部署在反向代理后面时，由uvicorn的 --proxy-headers / --forwarded-allow-ips 从 X-Forwarded-For 还原客户端地址
+    return request.client.host if request.client else "unknown"
+
+def rate_limited_response(retry_after, last_code):
+    """令牌耗尽时的响应：领取过的IP直接返回上次的邀请码，否则返回429"""
+    headers = {"Retry-After": str(max(1, int(retry_after + 0.999)))}
+    if last_code is not None:
+        return invite_code_response(last_code, "领取过于频繁，返回上次领取的邀请码", headers)
+    return JSONResponse(
+        status_code=429,
+        headers=headers,
+        content={
+            "success": False,
+            "message": "领取过于频繁，请稍后再试"
+        }
+    )
+
+def record_dispense(result, started):
+    metrics.inc("coze_dispense_total", {"result": result})
+    metrics.observe("coze_dispense_latency_seconds", time.perf_counter() - started)
+
+def invite_code_response(invite_code, message="获取邀请码成功", headers=None):
+    return JSONResponse(headers=headers, content={
+        "success": True,
+        "code": invite_code["code"],
+        "status": "未激活",  # 新状态
+        "source": invite_code["source"],
+        "message": message
+    })
+
+@app.get('/api/get_invite_code')
+async def get_unused_invite_code(request: Request, wait: float = 0):
+    """获取一个未激活的邀请码并将其状态改为已激活
+
+    wait大于0时，没有可用邀请码的请求会排队等待刷新完成，最多等待wait秒
+    """
+    started = time.perf_counter()
+    client_ip = get_client_ip(request)
+    allowed, retry_after, last_code = rate_limiter.acquire(client_ip)
+    if not allowed:
+        record_dispense("repeat" if last_code else "rate_limited", started)
+        return rate_limited_response(retry_after, last_code)
+
+    # 先从现有数据中尝试获取未激活邀请码
+    invite_code = get_and_activate_invite_code()
+
+    # 如果找到了未激活的邀请码，直接返回
+    if invite_code:
+        stock_forecaster.record()
+        maybe_refresh_early()
+        rate_limiter.remember(client_ip, invite_code)
+        record_dispense("success", started)
+        return invite_code_response(invite_code)
+
+    if wait > 0:
+        invite_code = await dispense_waiters.wait(min(wait, MAX_WAIT_SECONDS))
+        if invite_code:
+            maybe_refresh_early()
+            rate_limiter.remember(client_ip, invite_code)
+            record_dispense("waited", started)
+            return invite_code_response(invite_code)
+        rate_limiter.refund(client_ip, 1)
+        record_dispense("timeout", started)
+        return JSONResponse(
+            status_code=503,
+            headers={"Retry-After": "30"},
+            content={
+                "success": False,
+                "message": "等待邀请码超时，请稍后再试",
+                "current_step": update_status["current_step"]
+            }
+        )
+
+    # 如果没有找到未激活的邀请码，触发更新，空闲的账号立即开始刷新
+    rate_limiter.refund(client_ip, 1)
+    record_dispense("empty", started)
+    try:
+        triggered = refresh_when_empty()
+
+        if update_status["is_updating"]:
+            return JSONResponse(
+                status_code=423,
+                content={
+                    "success": False,
+                    "message": "正在更新邀请码数据，请稍后再试",
+                    "current_step": update_status["current_step"]
+                }
+            )
+
+        return JSONResponse(
+            status_code=202,
+            content={
+                "success": False,
+                "message": "没有可用的邀请码，已触发更新，请稍后再试" if triggered else "没有可用的邀请码，请稍后再试"
+            }
+        )
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={
+                "success": False,
+                "message": f"获取邀请码失败: {str(e)}"
+            }
+        )
+
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "100"))  # 批量领取接口单次最多发放的数量
+
+@app.get('/api/get_invite_codes')
+async def get_unused_invite_codes(request: Request, count: int = 1, source: str = None):
+    """一次获取最多count个未激活的邀请码并将其状态改为已激活，可以只从指定来源领取
+
+    库存不足时返回能取到的部分邀请码和剩余库存，并触发刷新
+    """
+    started = time.perf_counter()
+    if count < 1 or count > MAX_BATCH_SIZE:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "success": False,
+                "message": f"count 必须在 1 到 {MAX_BATCH_SIZE} 之间"
+            }
+        )
+
+    # 批量领取按数量扣减令牌，超过令牌桶容量的请求永远无法满足，直接拒绝；
+    # 批量分发任务所在的IP应加入 RATE_LIMIT_EXEMPT_IPS
+    client_ip = get_client_ip(request)
+    if RATE_LIMIT_ENABLED and client_ip not in RATE_LIMIT_EXEMPT_IPS and count > rate_limiter.capacity:
+        record_dispense("rate_limited", started)
+        return JSONResponse(
+            status_code=429,
+            content={
+                "success": False,
+                "message": f"count 超过了每个IP的领取上限 {RATE_LIMIT_CAPACITY:g}（RATE_LIMIT_CAPACITY），"
+                           f"批量分发请把所在IP加入 RATE_LIMIT_EXEMPT_IPS"
+            }
+        )
+    allowed, retry_after, _ = rate_limiter.acquire(client_ip, count)
+    if not allowed:
+        record_dispense("rate_limited", started)
+        return rate_limited_response(retry_after, None)
+
+    codes = get_and_activate_invite_codes(count, source)
+    if codes:
+        rate_limiter.remember(client_ip, codes[-1])
+    # 库存不足时退回没有发出的邀请码对应的令牌
+    rate_limiter.refund(client_ip, count - len(codes))
+    remaining = inventory.available_count(source)
+    if codes:
+        stock_forecaster.record(len(codes))
+    if len(codes) < count:
+        # 库存不足，请求一次刷新（多次请求会合并）
+        refresh_when_empty()
+    else:
+        maybe_refresh_early()
+    record_dispense("batch" if len(codes) == count else "batch_partial" if codes else "batch_empty", started)
+
+    if not codes:
+        return JSONResponse(
+            status_code=202,
+            content={
+                "success": False,
+                "codes": [],
+                "count": 0,
+                "requested": count,
+                "remaining": remaining,
+                "message": "没有可用的邀请码，已触发更新，请稍后再试"
+            }
+        )
+
+    return JSONResponse(content={
+        "success": True,
+        "codes": [{"code": item["code"], "status": "未激活", "source": item["source"]} for item in codes],
+        "count": len(codes),
+        "requested": count,
+        "remaining": remaining,
+        "message": "获取邀请码成功" if len(codes) == count else f"库存不足，只获取到 {len(codes)} 个邀请码，已触发更新"
+    })
+
+def collect_inventory_metrics():
+    return [("coze_invite_codes_available", {"source": source}, count)
+            for source, count in inventory.available_by_source().items()]
+
+metrics.add_collector(collect_inventory_metrics)
+
+@app.get('/metrics')
+async def get_metrics():
+    """Prometheus文本格式的运行指标"""
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
+class RefreshScheduler:
+    """运行在FastAPI事件循环上的刷新调度任务，Selenium抓取在有界线程池中执行"""
+
+    def __init__(self, executor):
+        self.executor = executor
+        self._loop = None
+        self._task = None
+        self._wakeup = None
+        self._requested = False
+        self._stopping = False
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run(), name="refresh-scheduler")
+        logger.info("启动定时任务")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        # Python 3.12之前，事件恰好已被设置时 wait_for 会吞掉取消，任务靠停止标记退出
+        self._stopping = True
+        self._wakeup.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        # 正在执行的抓取无法中断，不再等待它和排队中的任务
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        logger.info("定时任务已停止")
+
+    def request_refresh(self):
+        """请求立即刷新，可以在任意线程中调用，多次请求会合并为一次"""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            # 调度任务还没有启动时直接提交到线程池
+            self.executor.submit(self._refresh_sync, True)
+            return
+        self._requested = True
+        loop.call_soon_threadsafe(self._wakeup.set)
+
+    def reschedule(self):
+        """下次更新时间变化后唤醒调度任务重新计算等待时间，可以在任意线程中调用"""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _refresh_sync(self, force=False):
+        try:
+            update_invite_codes(force)
+        except Exception as e:
+            logger.error(f"更新任务出错: {str(e)}")
+            # 添加安全兜底，确保即使出错也会在一段时间后重试
+            retry_at = int((time.time() + 15 * 60) * 1000)  # 出错后15分钟再尝试
+            set_update_status(next_update_time=retry_at)
+
+    def _seconds_until_due(self):
+        # 下次更新时间由每次刷新根据库存计算
+        next_update = update_status["next_update_time"]
+        if not next_update:
+            return 0
+        return max(0, next_update / 1000 - time.time())
+
+    async def _run(self):
+        while not self._stopping:
+            # 立即刷新的请求不等各账号的正常刷新时间
+            force = self._requested
+            self._requested = False
+            self._wakeup.clear()
+            await self._loop.run_in_executor(self.executor, self._refresh_sync, force)
+            if self._seconds_until_due() <= 0:
+                # 刷新没有设置新的更新时间时，至少间隔最短刷新间隔，避免空转
+                set_update_status(next_update_time=int((time.time() + REFRESH_MIN_INTERVAL * 60) * 1000))
+
+            # 精确等待到下次更新时间，或者被立即刷新的请求唤醒
+            while not self._requested and not self._stopping:
+                delay = self._seconds_until_due()
+                if delay <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+refresh_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="refresh")
+refresh_scheduler = RefreshScheduler(refresh_executor)
+
+# 多进程部署（uvicorn --workers N）的协调文件
+LEADER_LOCK_FILE = "data/scheduler.lock"
+SHARED_STATUS_FILE = "data/status.json"
+REFRESH_REQUEST_FILE = "data/refresh.request"
+COORDINATION_POLL_INTERVAL = float(os.getenv("COORDINATION_POLL_INTERVAL", "0.5"))  # 检查其他进程变更的间隔（秒）
+# embedded：API进程负责抓取（默认）；external：抓取由独立的 scraper_worker.py 进程负责，API进程不启动浏览器
+SCRAPER_MODE = os.getenv("SCRAPER_MODE", "embedded").lower()
+
+SHARED_STATUS_FIELDS = ("is_updating", "current_step", "last_update_time", "next_update_time",
+                        "last_error", "step_timings", "last_duration")
+
+class WorkerCoordinator:
+    """多个工作进程之间的协调：持有文件锁的进程负责定时刷新和抓取，其他进程只处理请求
+
+    负责刷新的进程把状态写入共享文件，其他进程把刷新请求写入请求文件；
+    每个进程定期检查存储的变更戳，发现其他进程写入后重新加载库存，预序列化的响应随版本号失效
+    """
+
+    def __init__(self, can_lead=True):
+        self.can_lead = can_lead  # 为False时只处理请求，从不负责抓取
+        self.is_leader = fcntl is None and can_lead  # 不支持文件锁的平台只按单进程运行
+        self.remote_accounts = {}
+        self._lock_file = None
+        self._status_lock = Lock()
+        self._status_stamp = None
+        self._request_stamp = None
+        self._data_stamp = None
+        self._task = None
+
+    def try_acquire_leadership(self):
+        """尝试获得刷新锁，进程退出时操作系统会自动释放"""
+        if self.is_leader:
+            return True
+        if not self.can_lead:
+            return False
+        if fcntl is None:
+            self.is_leader = True
+            return True
+        lock_file = open(LEADER_LOCK_FILE, 'a+')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(os.getpid()))
+        lock_file.flush()
+        self._lock_file = lock_file
+        self.is_leader = True
+        logger.info(f"进程 {os.getpid()} 负责定时刷新和抓取")
+        return True
+
+    def release(self):
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+
+    def write_status(self):
+        """把当前状态原子写入共享文件"""
+        payload = json.dumps(build_status_payload(), ensure_ascii=False, separators=(',', ':'))
+        with self._status_lock:
+            tmp_path = f"{SHARED_STATUS_FILE}.tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(payload)
+                os.replace(tmp_path, SHARED_STATUS_FILE)
+            except OSError as e:
+                logger.warning(f"写入共享状态失败: {str(e)}")
+
+    def forward_refresh_request(self):
+        with open(REFRESH_REQUEST_FILE, 'w') as f:
+            f.write(str(time.time()))
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+            return st.st_mtime_ns, st.st_size
+        except FileNotFoundError:
+            return None
+
+    def _sync_status(self):
+        stamp = self._stat(SHARED_STATUS_FILE)
+        if stamp is None or stamp == self._status_stamp:
+            return
+        self._status_stamp = stamp
+        try:
+            with open(SHARED_STATUS_FILE, 'r', encoding='utf-8') as f:
+                payload = json.load(f)
+        except (OSError, ValueError):
+            return
+        update_status.update({key: payload.get(key) for key in SHARED_STATUS_FIELDS})
+        update_status["step_timings"] = update_status["step_timings"] or {}
+        session_cache_stats.update(payload.get("session_cache", {}))
+        self.remote_accounts = payload.get("accounts", {})
+        touch_update_status()
+
+    def _sync_requests(self):
+        stamp = self._stat(REFRESH_REQUEST_FILE)
+        if stamp is None or stamp == self._request_stamp:
+            return
+        self._request_stamp = stamp
+        logger.info("收到其他进程的刷新请求")
+        refresh_scheduler.request_refresh()
+
+    def _sync_data(self):
+        stamp = storage.change_stamp()
+        if stamp is None or stamp == self._data_stamp:
+            return
+        self._data_stamp = stamp
+        # 其他进程修改了数据，重新加载库存，版本号变化后缓存的响应自动失效
+        inventory.reload()
+        dispense_waiters.notify()
+
+    async def start(self):
+        self.try_acquire_leadership()
+        if not self.can_lead:
+            logger.info("抓取由独立的 scraper_worker.py 进程负责，本进程只处理请求")
+        if not self.is_leader and STORAGE_BACKEND != "sqlite":
+            # JSON存储的发放总是成功，多个进程同时发放会重复发放同一个邀请码
+            message = "多进程部署或 SCRAPER_MODE=external 需要 STORAGE_BACKEND=sqlite，JSON存储只支持单进程运行"
+            logger.error(message)
+            raise RuntimeError(message)
+        # 启动前已经存在的请求和数据变更不再处理
+        self._request_stamp = self._stat(REFRESH_REQUEST_FILE)
+        self._data_stamp = storage.change_stamp()
+        if self.is_leader:
+            await self._start_leader_tasks()
+        else:
+            self._sync_status()
+        self._task = asyncio.create_task(self._run(), name="worker-coordinator")
+
+    async def _start_leader_tasks(self):
+        # 启动自动更新任务
+        await refresh_scheduler.start()
+        # 启动数据变更日志压缩线程
+        threading.Thread(target=run_compactor, daemon=True).start()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(COORDINATION_POLL_INTERVAL)
+            try:
+                if not self.is_leader and self.try_acquire_leadership():
+                    # 原来负责刷新的进程已经退出
+                    inventory.reload()
+                    await self._start_leader_tasks()
+                if self.is_leader:
+                    self._sync_requests()
+                else:
+                    self._sync_status()
+                # 只有SQLite存储允许多个进程，JSON存储时本进程是唯一的写入者，不需要检查其他进程的变更
+                if STORAGE_BACKEND == "sqlite":
+                    self._sync_data()
+            except Exception as e:
+                logger.error(f"同步其他进程的状态失败: {str(e)}")
+
+coordinator = WorkerCoordinator(can_lead=SCRAPER_MODE != "external")
 
 @app.on_event("startup")
 async def startup_event():
     """应用启动时执行"""
     logger.info("应用启动，执行初始化更新")
+    event_broadcaster.bind_loop(asyncio.get_running_loop())
+    dispense_waiters.bind_loop(asyncio.get_running_loop())
     # 加载已保存的数据
-    data = load_data()
+    data = inventory.snapshot()
     if data:
-        update_status["last_update_time"] = data.get("last_update")
-        update_status["next_update_time"] = data.get("next_update")
-    
-    # 启动自动更新线程
-    threading.Thread(target=schedule_jobs, daemon=True).start()
-
-# 自定义 HTML 响应处理类
-class CustomHTMLResponse(HTMLResponse):
-    def __init__(self, content: str, *args, **kwargs):
-        # 从环境变量获取 Google Analytics ID
-        ga_id = os.getenv('GOOGLE_ANALYTICS_ID', '')
-        # 替换模板变量
-        content = content.replace('{{ GOOGLE_ANALYTICS_ID }}', ga_id)
-        super().__init__(content, *args, **kwargs)
+        set_update_status(last_update_time=data.get("last_update"), next_update_time=data.get("next_update"))
+
+    # 多进程部署时只有一个进程启动定时刷新，其他进程同步它的状态
+    await coordinator.start()
+    # 每个进程在内存中限流，定期保存领取记录
+    if RATE_LIMIT_ENABLED:
+        rate_limiter.load()
+        threading.Thread(target=rate_limiter.run_persister, daemon=True, name="rate-limit-persister").start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """应用关闭时停止定时任务并释放常驻浏览器"""
+    await coordinator.stop()
+    await refresh_scheduler.stop()
+    account_refresher.shutdown()
+    logger.info("应用关闭，释放浏览器池")
+    browser_pool.close_all()
+    process_reaper.reap_all()
+    if coordinator.is_leader:
+        inventory.compact()
+    coordinator.release()
+    rate_limiter.save()
+
+# Google Analytics ID 在启动时读取一次，渲染HTML模板时使用
+GOOGLE_ANALYTICS_ID = os.getenv('GOOGLE_ANALYTICS_ID', '')
+STATIC_IMMUTABLE_MAX_AGE = 31536000  # 带版本号的静态资源缓存一年
+STATIC_DEFAULT_MAX_AGE = 3600
+STATIC_MIN_COMPRESS_SIZE = 512  # 小于该大小的文件不压缩
+# 这些格式本身已经压缩过，再压缩没有收益
+STATIC_PRECOMPRESSED_TYPES = ("image/webp", "image/png", "image/jpeg", "image/gif", "font/woff2")
+
+def render_html_template(content):
+    """替换HTML中的模板变量"""
+    return content.replace('{{ GOOGLE_ANALYTICS_ID }}', GOOGLE_ANALYTICS_ID)
+
+class StaticAssetTable:
+    """静态资源表：文件在首次访问或修改后才重新读取，HTML模板预先渲染，并预先生成gzip/brotli版本"""
+
+    def __init__(self):
+        self._assets = {}
+        # 渲染HTML时会递归加载其引用的资源，需要可重入锁
+        self._lock = threading.RLock()
+
+    def get(self, full_path, stat_result):
+        asset = self._assets.get(full_path)
+        if asset is not None and asset["mtime"] == stat_result.st_mtime_ns and asset["size"] == stat_result.st_size \
+                and all(self._is_current(dep, mtime) for dep, mtime in asset["deps"].items()):
+            return asset
+
+        with self._lock:
+            asset = self._build(full_path, stat_result)
+            self._assets[full_path] = asset
+        return asset
+
+    def _is_current(self, path, mtime):
+        try:
+            return os.stat(path).st_mtime_ns == mtime
+        except OSError:
+            return False
+
+    def _build(self, full_path, stat_result):
+        with open(full_path, 'rb') as f:
+            body = f.read()
+
+        media_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+        deps = {}
+        if full_path.endswith('.html'):
+            media_type = "text/html"  # Response 会自动追加 charset=utf-8
+            content = render_html_template(body.decode('utf-8'))
+            content = self._fingerprint_links(content, os.path.dirname(full_path), deps)
+            body = content.encode('utf-8')
+
+        digest = hashlib.sha1(body).hexdigest()[:20]
+        asset = {
+            "mtime": stat_result.st_mtime_ns,
+            "size": stat_result.st_size,
+            "deps": deps,
+            "media_type": media_type,
+            "etag": digest,  # 各压缩版本的ETag在此基础上加编码后缀
+            "version": digest[:10],
+            "last_modified": formatdate(stat_result.st_mtime, usegmt=True),
+            "variants": {"identity": body}
+        }
+
+        if len(body) >= STATIC_MIN_COMPRESS_SIZE and not media_type.startswith(STATIC_PRECOMPRESSED_TYPES):
+            gzipped = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(gzipped) < len(body):
+                asset["variants"]["gzip"] = gzipped
+            if brotli is not None:
+                compressed = brotli.compress(body, quality=11)
+                if len(compressed) < len(body):
+                    asset["variants"]["br"] = compressed
+
+        logger.info(f"已加载静态资源 {os.path.basename(full_path)}，压缩版本: {', '.join(asset['variants'])}")
+        return asset
+
+    def _fingerprint_links(self, content, directory, deps):
+        """给HTML中引用的本地静态资源加上内容版本号，使其可以长期缓存"""
+        def replace(match):
+            name = match.group(2)
+            path = os.path.join(directory, name)
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                return match.group(0)
+            if not os.path.isfile(path):
+                return match.group(0)
+            deps[path] = stat_result.st_mtime_ns
+            version = self.get(path, stat_result)["version"]
+            return f'{match.group(1)}/static/{name}?v={version}{match.group(1)}'
+
+        return re.sub(r'(["\'])/static/([\w\-./]+)\1', replace, content)
+
+static_assets = StaticAssetTable()
+
+def choose_encoding(accept_encoding, variants):
+    """根据 Accept-Encoding 选择压缩版本，优先brotli"""
+    accepted = {}
+    for part in accept_encoding.split(','):
+        token, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[token.strip().lower()] = quality
+
+    for encoding in ("br", "gzip"):
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if encoding in variants and quality > 0:
+            return encoding
+    return "identity"
+
+def variant_etag(etag, encoding):
+    """强校验的ETag必须区分压缩版本，identity使用原始哈希，其他版本加上编码后缀"""
+    return f'"{etag}"' if encoding == "identity" else f'"{etag}-{encoding}"'
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match 中任意一个版本（忽略W/前缀和编码后缀）与内容哈希一致即可返回304"""
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        tag = tag[2:] if tag.startswith("W/") else tag
+        base = tag.strip('"').split("-", 1)[0]
+        if base == etag:
+            return True
+    return False
 
 # 自定义静态文件处理
 class CustomStaticFiles(StaticFiles):
-    async def get_response(self, path: str, scope):
-        response = await super().get_response(path, scope)
-        if path.endswith('.html'):
-            content = await response.body()
-            return CustomHTMLResponse(content.decode())
-        return response
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        asset = static_assets.get(str(full_path), stat_result)
+        request_headers = Headers(scope=scope)
+
+        # 请求中带有与内容一致的版本号时可以永久缓存
+        query = dict(parse_qsl(scope.get("query_string", b"").decode('latin-1')))
+        if query.get("v") == asset["version"]:
+            cache_control = f"public, max-age={STATIC_IMMUTABLE_MAX_AGE}, immutable"
+        elif asset["media_type"].startswith("text/html"):
+            cache_control = "no-cache"
+        else:
+            cache_control = f"public, max-age={STATIC_DEFAULT_MAX_AGE}"
+
+        encoding = choose_encoding(request_headers.get("accept-encoding", ""), asset["variants"])
+        headers = {
+            "ETag": variant_etag(asset["etag"], encoding),
+            "Last-Modified": asset["last_modified"],
+            "Cache-Control": cache_control,
+            "Vary": "Accept-Encoding"
+        }
+
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match and etag_matches(if_none_match, asset["etag"]):
+            return Response(status_code=304, headers=headers)
+
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        body = asset["variants"][encoding]
+        if scope["method"] == "HEAD":
+            headers["Content-Length"] = str(len(body))
+            body = b""
+        return Response(content=body, status_code=status_code, media_type=asset["media_type"], headers=headers)
 
 # 修改静态文件挂载
 app.mount("/static", CustomStaticFiles(directory="static"), name="static")
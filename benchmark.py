@@ -0,0 +1,302 @@
+"""离线性能测试
+
+所有测试都在本地运行，浏览器相关的测试使用本地模拟站点（fake_coze.py），不需要真实的Coze账号和外网：
+
+    # 比较开启和关闭资源屏蔽时的页面加载时间和峰值内存
+    python benchmark.py load --blocking both --runs 3
+
+    # 端到端刷新耗时、各步骤耗时和浏览器内存，可以注入延迟和接口失败
+    python benchmark.py refresh --runs 5 --latency 100 --fail-rate 0.1
+
+    # 启动服务后并发请求接口，统计吞吐量和延迟（服务不配置账号，测试期间不会抓取）
+    python benchmark.py api --concurrency 20 --duration 10
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import urllib3
+from dotenv import dotenv_values
+from selenium.webdriver.support.ui import WebDriverWait
+
+import app
+from fake_coze import FakeCozeSite
+
+
+class RssSampler(threading.Thread):
+    """定时采样进程树的常驻内存，记录峰值"""
+
+    def __init__(self, pid, interval=0.1, exclude_self=False):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.exclude_self = exclude_self
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            rss = app.get_process_tree_rss(self.pid)
+            if rss and self.exclude_self:
+                # 只统计浏览器进程，去掉测试进程自身
+                rss -= get_process_rss(os.getpid())
+            if rss:
+                self.peak = max(self.peak, rss)
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def get_process_rss(pid):
+    try:
+        with open(f"/proc/{pid}/status", 'r') as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def format_mb(value):
+    return f"{value / (1024 * 1024):.1f}MB"
+
+
+def start_site(args):
+    site = FakeCozeSite(latency_ms=args.latency, jitter_ms=args.jitter, fail_rate=args.fail_rate,
+                        render_delay_ms=args.render_delay, codes=args.codes).start()
+    print(f"模拟站点: {site.base_url}（延迟 {args.latency}±{args.jitter}ms，接口失败率 {args.fail_rate:.0%}）")
+    return site
+
+
+def run_load(args):
+    """启动新的浏览器打开页面，比较开启和关闭资源屏蔽时的加载时间、传输量和峰值内存"""
+    site = None
+    url = args.url
+    if not url:
+        site = start_site(args)
+        url = site.login_url
+
+    modes = {"on": [True], "off": [False], "both": [False, True]}[args.blocking]
+    try:
+        for blocking in modes:
+            name = "屏蔽" if blocking else "不屏蔽"
+            results = []
+            for i in range(args.runs):
+                driver = app.create_chrome_driver(blocking=blocking)
+                pid = driver.service.process.pid if getattr(driver.service, "process", None) else None
+                sampler = RssSampler(pid)
+                sampler.start()
+                try:
+                    started = time.perf_counter()
+                    driver.get(url)
+                    app.wait_for_ready_state(driver, WebDriverWait(driver, 60))
+                    load_time = time.perf_counter() - started
+                    app.wait_for_page_settled(driver)
+                    settle_time = time.perf_counter() - started
+                    requests, transferred = driver.execute_script("""
+                        const entries = performance.getEntriesByType('resource');
+                        return [entries.length, entries.reduce((sum, e) => sum + (e.transferSize || 0), 0)];
+                    """)
+                finally:
+                    sampler.stop()
+                    app.quit_driver(driver)
+                print(f"{name} 第{i + 1}次: 加载 {load_time:.2f}s, 峰值内存 {format_mb(sampler.peak)}")
+                results.append((load_time, settle_time, requests, transferred, sampler.peak))
+
+            load_time, settle_time, requests, transferred, rss = (statistics.median(column) for column in zip(*results))
+            print(f"{name:<8} 加载 {load_time:6.2f}s  静止 {settle_time:6.2f}s  请求 {requests:5.0f}  "
+                  f"传输 {transferred / 1024:8.1f}KB  峰值内存 {format_mb(rss)}")
+    finally:
+        if site:
+            site.stop()
+
+
+def run_refresh(args):
+    """对模拟站点执行完整的账号刷新，统计端到端耗时、各步骤耗时和浏览器内存"""
+    site = start_site(args)
+    app.COZE_LOGIN_URL = site.login_url
+    app.COZE_INVITE_URL = site.invite_url
+    app.DIRECT_REFRESH_ENABLED = args.direct
+    app.SESSION_DIR = tempfile.mkdtemp(prefix="benchmark-sessions-")
+    account = {"id": "benchmark", "password": "benchmark", "source": "基准"}
+
+    sampler = RssSampler(os.getpid(), exclude_self=True)
+    sampler.start()
+    durations, failures = [], 0
+    steps = {}
+    try:
+        for i in range(args.runs):
+            if args.cold:
+                # 冷启动：每次都重新启动浏览器并执行完整登录
+                app.browser_pool.close_all()
+                app.clear_session(account["id"])
+            app.update_status["step_timings"] = {}
+            started = time.perf_counter()
+            try:
+                codes = app.scrape_account(account)
+                ok = len(codes) == args.codes
+            except Exception as e:
+                print(f"第{i + 1}次刷新失败: {str(e)}")
+                ok = False
+            elapsed = time.perf_counter() - started
+            if ok:
+                durations.append(elapsed)
+            else:
+                failures += 1
+            for step, seconds in app.update_status["step_timings"].items():
+                steps.setdefault(re.sub(r"^\[.*?\] ", "", step), []).append(seconds)
+            print(f"第{i + 1}次: {'成功' if ok else '失败'} {elapsed:.2f}s")
+    finally:
+        sampler.stop()
+        app.browser_pool.close_all()
+        site.stop()
+
+    print()
+    if durations:
+        print(f"刷新耗时: 中位数 {statistics.median(durations):.2f}s  p95 {percentile(durations, 95):.2f}s  "
+              f"最大 {max(durations):.2f}s")
+    print(f"成功 {len(durations)} 次，失败 {failures} 次，浏览器峰值内存 {format_mb(sampler.peak)}")
+    print(f"会话统计: {app.session_cache_stats}")
+    print("各步骤耗时（中位数 / 次数）:")
+    for step, values in sorted(steps.items(), key=lambda item: -statistics.median(item[1])):
+        print(f"  {step:<16} {statistics.median(values):7.3f}s  x{len(values)}")
+
+
+def run_api(args):
+    """启动uvicorn服务，并发请求接口，统计吞吐量和延迟
+
+    服务不配置任何账号，测试期间不会启动浏览器抓取，结果只反映接口本身的开销
+    """
+    workdir = tempfile.mkdtemp(prefix="benchmark-api-")
+    os.makedirs(os.path.join(workdir, "data"))
+    # 预先放入一批未激活邀请码
+    seed = {
+        "codes": [{"code": f"BENCH{i:06d}", "status": "未激活", "source": "基准"} for i in range(args.seed_codes)],
+        "last_update": None,
+        "next_update": None
+    }
+    with open(os.path.join(workdir, "data", "data.json"), 'w', encoding='utf-8') as f:
+        json.dump(seed, f, ensure_ascii=False)
+
+    # 清空环境变量和 .env 中的账号（load_dotenv 不覆盖已有的环境变量），账号文件指向不存在的路径
+    env = {key: value for key, value in os.environ.items() if not re.match(r"^ACCOUNT\d+_", key)}
+    for key in dotenv_values(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")):
+        if re.match(r"^ACCOUNT\d+_", key):
+            env[key] = ""
+    env.update(PYTHONPATH=os.path.dirname(os.path.abspath(__file__)),
+               ACCOUNTS_FILE=os.path.join(workdir, "data", "accounts.json"),
+               RATE_LIMIT_ENABLED="false")  # 所有请求都来自本机，不限流
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"],
+        cwd=workdir, env=env
+    )
+    base_url = f"http://127.0.0.1:{args.port}"
+    http = urllib3.PoolManager(maxsize=args.concurrency, retries=False, timeout=urllib3.Timeout(total=30))
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                if http.request("GET", f"{base_url}/api/codes").status == 200:
+                    break
+            except urllib3.exceptions.HTTPError:
+                pass
+            if time.time() > deadline or server.poll() is not None:
+                raise RuntimeError("服务启动失败")
+            time.sleep(0.2)
+
+        paths = [f"/api/{endpoint}" for endpoint in args.endpoints.split(",")]
+        results = {path: {"latencies": [], "statuses": {}} for path in paths}
+        lock = threading.Lock()
+        stop_at = time.time() + args.duration
+
+        def worker(index):
+            n = index
+            while time.time() < stop_at:
+                path = paths[n % len(paths)]
+                n += 1
+                started = time.perf_counter()
+                try:
+                    status = http.request("GET", base_url + path).status
+                except urllib3.exceptions.HTTPError:
+                    status = "error"
+                elapsed = time.perf_counter() - started
+                with lock:
+                    results[path]["latencies"].append(elapsed)
+                    results[path]["statuses"][status] = results[path]["statuses"].get(status, 0) + 1
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        print(f"并发 {args.concurrency}，持续 {args.duration}s")
+        for path, result in results.items():
+            latencies = result["latencies"]
+            if not latencies:
+                continue
+            print(f"{path:<24} {len(latencies) / args.duration:8.1f} req/s  "
+                  f"p50 {percentile(latencies, 50) * 1000:7.1f}ms  p95 {percentile(latencies, 95) * 1000:7.1f}ms  "
+                  f"p99 {percentile(latencies, 99) * 1000:7.1f}ms  状态码 {result['statuses']}")
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="使用本地模拟站点的离线性能测试")
+    subparsers = parser.add_subparsers(dest="suite", required=True)
+
+    def add_site_arguments(subparser):
+        subparser.add_argument("--latency", type=int, default=0, help="模拟站点每个请求的延迟（毫秒）")
+        subparser.add_argument("--jitter", type=int, default=0, help="延迟的随机抖动范围（毫秒）")
+        subparser.add_argument("--fail-rate", type=float, default=0.0, help="模拟站点接口返回500的概率")
+        subparser.add_argument("--render-delay", type=int, default=0, help="模拟站点渲染登录表单和邀请码的延迟（毫秒）")
+        subparser.add_argument("--codes", type=int, default=5, help="模拟站点的邀请码数量")
+
+    load = subparsers.add_parser("load", help="比较资源屏蔽开启和关闭时的页面加载时间和峰值内存")
+    load.add_argument("--blocking", choices=["on", "off", "both"], default="both", help="是否屏蔽资源（默认两种都测）")
+    load.add_argument("--runs", type=int, default=3, help="每种配置运行的次数")
+    load.add_argument("--url", help="测试的页面地址，默认使用模拟站点的登录页")
+    add_site_arguments(load)
+
+    refresh = subparsers.add_parser("refresh", help="端到端刷新耗时、各步骤耗时和浏览器内存")
+    refresh.add_argument("--runs", type=int, default=5, help="刷新次数")
+    refresh.add_argument("--cold", action="store_true", help="每次刷新都重新启动浏览器并完整登录")
+    refresh.add_argument("--direct", action="store_true", help="允许不启动浏览器直接请求邀请码接口")
+    add_site_arguments(refresh)
+
+    api = subparsers.add_parser("api", help="并发请求接口，统计吞吐量和延迟")
+    api.add_argument("--concurrency", type=int, default=10, help="并发请求数")
+    api.add_argument("--duration", type=float, default=10, help="持续时间（秒）")
+    api.add_argument("--endpoints", default="codes,invite_codes,get_invite_code", help="逗号分隔的接口名")
+    api.add_argument("--seed-codes", type=int, default=10000, help="预先放入的未激活邀请码数量")
+    api.add_argument("--port", type=int, default=8765, help="测试服务端口")
+
+    args = parser.parse_args()
+    {"load": run_load, "refresh": run_refresh, "api": run_api}[args.suite](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""本地模拟的Coze站点，用于离线性能测试
+
+页面结构和抓取流程使用的选择器保持一致：登录按钮、登录对话框、账号登录标签页、
+#Identity_input / #Password_input、快速开始、立即邀请和 .invite-code-item 邀请码列表。
+邀请码通过 /api/invite/list 接口返回，网络响应捕获和直接请求接口也可以使用。
+
+    python fake_coze.py --port 9000 --latency 200 --fail-rate 0.1
+
+然后在 .env 中设置：
+    COZE_LOGIN_URL=http://127.0.0.1:9000/space-preview?
+    COZE_INVITE_URL=http://127.0.0.1:9000/space/?from=landingpage
+"""
+import argparse
+import json
+import random
+import secrets
+import string
+import threading
+import time
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+LOGIN_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>扣子</title></head>
+<body>
+<button id="open-login">登录</button>
+<script>
+document.getElementById('open-login').addEventListener('click', () => setTimeout(() => {
+    if (document.querySelector('div[role="dialog"]')) return;
+    const dialog = document.createElement('div');
+    dialog.setAttribute('role', 'dialog');
+    dialog.innerHTML = `
+        <div class="arco-tabs">
+            <div id="arco-tabs-0-tab-0">验证码登录</div>
+            <div id="arco-tabs-0-tab-1">账号登录</div>
+        </div>
+        <div id="arco-tabs-0-panel-1" style="display:none"><div><div><form onsubmit="return false">
+            <div><input id="Identity_input"></div>
+            <div><input id="Password_input" type="password"></div>
+            <div></div><div></div><div><span id="login-error"></span></div>
+            <div><button type="button">确认</button></div>
+        </form></div></div>`;
+    document.body.appendChild(dialog);
+    document.getElementById('arco-tabs-0-tab-1').addEventListener('click', () => {
+        document.getElementById('arco-tabs-0-panel-1').style.display = 'block';
+    });
+    dialog.querySelector('form > div:nth-child(6) > button').addEventListener('click', async () => {
+        const response = await fetch('/api/login', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({
+                id: document.getElementById('Identity_input').value,
+                password: document.getElementById('Password_input').value
+            })
+        });
+        if (response.ok) {
+            location.href = '/space/develop';
+        } else {
+            document.getElementById('login-error').textContent = '登录失败';
+        }
+    });
+}, %(render_delay)d));
+</script>
+</body></html>
+"""
+
+HOME_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>扣子</title></head>
+<body>
+<div id="quick-start" style="cursor:pointer">快速开始</div>
+<script>
+document.getElementById('quick-start').addEventListener('click', () => {
+    location.href = '/space/?from=landingpage';
+});
+</script>
+</body></html>
+"""
+
+INVITE_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>扣子</title></head>
+<body>
+<button id="invite-now">立即邀请</button>
+<div id="codes"></div>
+<script>
+document.getElementById('invite-now').addEventListener('click', async () => {
+    const response = await fetch('/api/invite/list', {credentials: 'same-origin'});
+    if (!response.ok) return;
+    const payload = await response.json();
+    setTimeout(() => {
+        document.getElementById('codes').innerHTML = payload.data.invite_codes.map(item => `
+            <div class="invite-code-item"><div class="invite-code-row">
+                <div class="items-center coz-fg-plus">${item.invite_code}</div>
+                <div><button><div><span>${item.used ? '已激活' : '未激活'}</span></div></button></div>
+            </div></div>`).join('');
+    }, %(render_delay)d);
+});
+</script>
+</body></html>
+"""
+
+ANONYMOUS_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>扣子</title></head>
+<body><button onclick="location.href='/space-preview?'">登录</button></body></html>
+"""
+
+
+class FakeCozeSite:
+    """在后台线程中运行的模拟站点，支持注入延迟和接口失败"""
+
+    def __init__(self, host="127.0.0.1", port=0, latency_ms=0, jitter_ms=0, fail_rate=0.0,
+                 render_delay_ms=0, codes=5, used=2, account=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.fail_rate = fail_rate
+        self.render_delay_ms = render_delay_ms
+        self.account = account  # (账号, 密码)，为None时接受任意账号
+        self.codes = [
+            {"invite_code": "".join(random.choices(string.ascii_uppercase + string.digits, k=8)), "used": i < used}
+            for i in range(codes)
+        ]
+        self.sessions = set()
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def login_url(self):
+        return f"{self.base_url}/space-preview?"
+
+    @property
+    def invite_url(self):
+        return f"{self.base_url}/space/?from=landingpage"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True, name="fake-coze")
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _make_handler(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                site._handle(self)
+
+            def do_POST(self):
+                site._handle(self)
+
+        return Handler
+
+    def _delay(self):
+        delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+    def _session(self, handler):
+        cookie = SimpleCookie(handler.headers.get("Cookie", ""))
+        token = cookie["sessionid"].value if "sessionid" in cookie else None
+        return token if token in self.sessions else None
+
+    def _send(self, handler, status, body, content_type="text/html; charset=utf-8", headers=None):
+        data = body.encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def _send_json(self, handler, status, payload, headers=None):
+        self._send(handler, status, json.dumps(payload, ensure_ascii=False), "application/json; charset=utf-8", headers)
+
+    def _handle(self, handler):
+        with self._lock:
+            self.requests += 1
+        self._delay()
+        path = urlsplit(handler.path).path
+        pages = {"render_delay": self.render_delay_ms}
+
+        if path.startswith("/api/") and random.random() < self.fail_rate:
+            self._send_json(handler, 500, {"code": 500, "msg": "injected failure"})
+        elif path == "/api/login" and handler.command == "POST":
+            length = int(handler.headers.get("Content-Length", 0))
+            try:
+                credentials = json.loads(handler.rfile.read(length) or b"{}")
+            except ValueError:
+                credentials = {}
+            if self.account and (credentials.get("id"), credentials.get("password")) != tuple(self.account):
+                self._send_json(handler, 401, {"code": 401, "msg": "账号或密码错误"})
+                return
+            token = secrets.token_hex(16)
+            self.sessions.add(token)
+            self._send_json(handler, 200, {"code": 0}, {"Set-Cookie": f"sessionid={token}; Path=/; HttpOnly"})
+        elif path == "/api/invite/list":
+            if not self._session(handler):
+                self._send_json(handler, 401, {"code": 401, "msg": "未登录"})
+                return
+            self._send_json(handler, 200, {"code": 0, "data": {"invite_codes": self.codes}})
+        elif path == "/space-preview":
+            self._send(handler, 200, LOGIN_PAGE % pages)
+        elif path.startswith("/space"):
+            if not self._session(handler):
+                self._send(handler, 200, ANONYMOUS_PAGE)
+            elif path == "/space/develop":
+                self._send(handler, 200, HOME_PAGE)
+            else:
+                self._send(handler, 200, INVITE_PAGE % pages)
+        else:
+            self._send(handler, 404, "not found", "text/plain; charset=utf-8")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟的Coze站点")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=int, default=0, help="每个请求增加的延迟（毫秒）")
+    parser.add_argument("--jitter", type=int, default=0, help="延迟的随机抖动范围（毫秒）")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="接口请求返回500的概率")
+    parser.add_argument("--render-delay", type=int, default=0, help="页面渲染登录表单和邀请码列表的延迟（毫秒）")
+    parser.add_argument("--codes", type=int, default=5, help="邀请码数量")
+    parser.add_argument("--used", type=int, default=2, help="其中已激活的数量")
+    args = parser.parse_args()
+
+    site = FakeCozeSite(args.host, args.port, args.latency, args.jitter, args.fail_rate,
+                        args.render_delay, args.codes, args.used)
+    print(f"模拟站点已启动: {site.base_url}")
+    print(f"COZE_LOGIN_URL={site.login_url}")
+    print(f"COZE_INVITE_URL={site.invite_url}")
+    try:
+        site._server.serve_forever()
+    except KeyboardInterrupt:
+        site.stop()
+
+
+if __name__ == "__main__":
+    main()
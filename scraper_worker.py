@@ -0,0 +1,46 @@
+"""独立的抓取进程
+
+API进程设置 SCRAPER_MODE=external 后不再启动浏览器，只处理请求；本进程负责定时刷新、
+账号抓取和数据压缩，Chrome卡死或内存暴涨都不会影响接口：
+
+    STORAGE_BACKEND=sqlite SCRAPER_MODE=external uvicorn app:app --workers 2
+    STORAGE_BACKEND=sqlite python scraper_worker.py
+
+两个进程通过 data/ 目录通信：API进程收到的刷新请求写入 data/refresh.request，
+本进程抓取的结果写入共享的SQLite数据库，更新状态写入 data/status.json。
+"""
+import asyncio
+import signal
+
+import app
+
+
+async def run():
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:  # Windows只能通过KeyboardInterrupt退出
+            pass
+
+    # .env 中的 SCRAPER_MODE=external 只针对API进程，本进程总是负责抓取
+    app.coordinator.can_lead = True
+    await app.startup_event()
+    if not app.coordinator.is_leader:
+        app.logger.info("另一个进程正在负责抓取，等待它退出后接管")
+    try:
+        await stop_event.wait()
+    finally:
+        await app.shutdown_event()
+
+
+def main():
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()